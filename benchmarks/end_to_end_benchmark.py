@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+
+# Runs whole download sessions offline against fake_yt_dlp.py, which stands in for yt-dlp, and
+# reports what they get through:
+#   items/min         links downloaded and moved per minute of the session
+#   parser lines/s    output lines taken in per second spent taking them in and parsing them
+#   UI CPU            share of yt-dlp-sc's CPU time spent drawing frames, parsing included
+#   session CPU       yt-dlp-sc's CPU time as a share of the session's wall time
+#   move MiB/s        how fast finished files went from the temporary to the final directory
+#
+# Usage: python3 benchmarks/end_to_end_benchmark.py [--items N] [--jobs 1,4] [--size MiB]
+#            [--seconds S] [--transcript log] [--final-directory dir] [--verify-moves] [--check]
+#
+# --jobs 1 is the sequential download_queue(), more runs download_queue_parallel(). The embedded
+# engine imports yt_dlp instead of running it, so it can't be driven by the fake and isn't run.
+# Give --final-directory on another filesystem to time copies rather than renames. With --check
+# the exit code is 1 if any link was not downloaded and moved, so it works as a smoke test.
+#
+# Every session runs in its own throwaway home directory, so the user's options and queue are not
+# touched, and nothing goes over the network: URL checks are answered without a request.
+
+import contextlib
+import functools
+import importlib.util
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+benchmark_directory = os.path.dirname(os.path.abspath(__file__))
+script_path = os.path.join(benchmark_directory, "..", "yt-dlp-sc.py")
+fake_yt_dlp_path = os.path.join(benchmark_directory, "fake_yt_dlp.py")
+
+# Loads yt-dlp-sc.py as a module. The file name has dashes, so it can't be imported normally.
+def load_yt_dlp_sc():
+    spec = importlib.util.spec_from_file_location("yt_dlp_sc", script_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+# Reads the command line into a dict of settings
+def parse_arguments(arguments):
+    settings = {"items": 20, "jobs": [1, 4], "size": 8, "seconds": 2.0, "transcript": None,
+                "final_directory": None, "verify_moves": False, "check": False}
+    index = 0
+    while index < len(arguments):
+        argument = arguments[index]
+        if argument in ("--verify-moves", "--check"):
+            settings[argument[2:].replace("-", "_")] = True
+            index += 1
+            continue
+        if index + 1 >= len(arguments):
+            sys.exit(f"{argument} needs a value")
+        value = arguments[index + 1]
+        if argument == "--items":
+            settings["items"] = int(value)
+        elif argument == "--jobs":
+            settings["jobs"] = [int(jobs) for jobs in value.split(",")]
+        elif argument == "--size":
+            settings["size"] = float(value)
+        elif argument == "--seconds":
+            settings["seconds"] = float(value)
+        elif argument == "--transcript":
+            settings["transcript"] = os.path.abspath(value)
+        elif argument == "--final-directory":
+            settings["final_directory"] = os.path.abspath(value)
+        else:
+            sys.exit(f"Unknown option {argument}")
+        index += 2
+    return settings
+
+# Puts a yt-dlp on PATH that runs fake_yt_dlp.py, and sets what the fake replays
+def install_fake_yt_dlp(home, settings):
+    bin_directory = os.path.join(home, "bin")
+    os.makedirs(bin_directory)
+    wrapper = os.path.join(bin_directory, "yt-dlp")
+    with open(wrapper, 'w') as f:
+        f.write(f"#!/bin/sh\nexec '{sys.executable}' '{fake_yt_dlp_path}' \"$@\"\n")
+    os.chmod(wrapper, 0o755)
+    os.environ["PATH"] = bin_directory + os.pathsep + os.environ["PATH"]
+    os.environ["FAKE_YT_DLP_SIZE"] = str(int(settings["size"] * 1024 * 1024))
+    os.environ["FAKE_YT_DLP_SECONDS"] = str(settings["seconds"])
+    if settings["transcript"]:
+        os.environ["FAKE_YT_DLP_TRANSCRIPT"] = settings["transcript"]
+
+# Wraps a module function so the time spent in it is added to timings[name]
+def timed(timings, name, function, clock=time.perf_counter):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        started = clock()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            timings[name] += clock() - started
+    return wrapper
+
+# Returns the process's own CPU time, all threads included, without its children's
+def process_cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+# Sums a session metric over all its labels, or over those with the given result
+def metric_total(yt_dlp_sc, name, result=None):
+    return sum(value for (metric, labels), value in (yt_dlp_sc.session_metrics or {}).items()
+               if metric == name and (result is None or ("result", result) in labels))
+
+# Runs one session of `jobs` downloads at once over settings["items"] fake links, and returns its numbers
+def run_session(jobs, settings):
+    original_environment = dict(os.environ)
+    home = tempfile.mkdtemp(prefix="yt-dlp-sc-bench-")
+    try:
+        os.environ["HOME"] = home
+        os.makedirs(os.path.join(home, ".config"))
+        install_fake_yt_dlp(home, settings)
+        yt_dlp_sc = load_yt_dlp_sc()
+        temp_directory = os.path.join(home, "temp")
+        final_directory = settings["final_directory"] or os.path.join(home, "final")
+        if settings["final_directory"]:
+            final_directory = tempfile.mkdtemp(prefix="yt-dlp-sc-bench-", dir=settings["final_directory"])
+        os.makedirs(temp_directory)
+        os.makedirs(final_directory, exist_ok=True)
+
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            yt_dlp_sc.write_default_options()
+            yt_dlp_sc.download_directory = final_directory
+            yt_dlp_sc.temp_download_directory = temp_directory
+            yt_dlp_sc.use_temp_folder = True
+            yt_dlp_sc.suppress_output = True
+            yt_dlp_sc.debug = False
+            yt_dlp_sc.yt_dlp_options = ""
+            yt_dlp_sc.temp_min_free_mb = 0
+            yt_dlp_sc.max_retries = 0
+            yt_dlp_sc.verify_moves = settings["verify_moves"]
+            yt_dlp_sc.probe_url = lambda url: None
+            yt_dlp_sc.enqueue_links([f"https://www.youtube.com/watch?v=bench{number:06d}" for number in range(settings["items"])])
+
+            # The panel is drawn as it would be on a terminal, but into /dev/null
+            yt_dlp_sc.load_session_modules()
+            console = importlib.import_module("rich.console").Console(file=devnull, force_terminal=True, width=120, height=40)
+            yt_dlp_sc.Live = functools.partial(yt_dlp_sc.Live, console=console)
+
+            timings = {"parse": 0.0, "draw": 0.0}
+            lines = [0]
+            ingest_job_line = yt_dlp_sc.ingest_job_line
+            def counted_ingest_job_line(job, line):
+                lines[0] += 1
+                ingest_job_line(job, line)
+            yt_dlp_sc.ingest_job_line = timed(timings, "parse", counted_ingest_job_line)
+            yt_dlp_sc.flush_job_line = timed(timings, "parse", yt_dlp_sc.flush_job_line)
+            # Frames are drawn on the event loop's thread, so its CPU clock times them
+            yt_dlp_sc.FrameRenderer.draw = timed(timings, "draw", yt_dlp_sc.FrameRenderer.draw, time.thread_time)
+
+            cpu_started = process_cpu_time()
+            started = time.monotonic()
+            if jobs > 1:
+                yt_dlp_sc.download_queue_parallel(jobs)
+            else:
+                yt_dlp_sc.download_queue()
+            seconds = time.monotonic() - started
+            cpu_seconds = process_cpu_time() - cpu_started
+
+        moved_bytes = metric_total(yt_dlp_sc, "yt_dlp_sc_moved_bytes_total")
+        move_seconds = metric_total(yt_dlp_sc, "yt_dlp_sc_move_seconds_total")
+        return {
+            "session": "sequential" if jobs == 1 else f"parallel -j {jobs}",
+            "moved": int(metric_total(yt_dlp_sc, "yt_dlp_sc_moves_total", "moved")),
+            "seconds": seconds,
+            "lines": lines[0],
+            "parse_seconds": timings["parse"],
+            "draw_seconds": timings["draw"],
+            "cpu_seconds": cpu_seconds,
+            "moved_bytes": moved_bytes,
+            "move_seconds": move_seconds,
+        }
+    finally:
+        os.environ.clear()
+        os.environ.update(original_environment)
+        shutil.rmtree(home, ignore_errors=True)
+        if settings["final_directory"]:
+            shutil.rmtree(final_directory, ignore_errors=True)
+
+def print_result(result):
+    items_per_minute = result["moved"] / result["seconds"] * 60
+    lines_per_second = result["lines"] / result["parse_seconds"] if result["parse_seconds"] else 0
+    ui_share = result["draw_seconds"] / result["cpu_seconds"] * 100 if result["cpu_seconds"] else 0
+    cpu_share = result["cpu_seconds"] / result["seconds"] * 100
+    move_rate = result["moved_bytes"] / 1024 / 1024 / result["move_seconds"] if result["move_seconds"] else 0
+    print(f"{result['session']:<14} {result['moved']:>6} {result['seconds']:>8.1f} {items_per_minute:>10.1f} "
+          f"{result['lines']:>9} {lines_per_second:>15,.0f} {ui_share:>7.1f}% {cpu_share:>12.1f}% {move_rate:>11,.1f}")
+
+def main():
+    settings = parse_arguments(sys.argv[1:])
+    transcript = os.path.basename(settings["transcript"] or "dash_1018_fragments.log")
+    print(f"{settings['items']} links of {settings['size']:g} MiB each, replaying {transcript} (over {settings['seconds']:g}s if it is untimed)")
+    print(f"{'session':<14} {'moved':>6} {'wall s':>8} {'items/min':>10} {'lines':>9} {'parser lines/s':>15} {'UI CPU':>8} {'session CPU':>13} {'move MiB/s':>11}")
+    incomplete = False
+    for jobs in settings["jobs"]:
+        result = run_session(jobs, settings)
+        print_result(result)
+        incomplete = incomplete or result["moved"] < settings["items"]
+    if settings["check"] and incomplete:
+        print("Not every link was downloaded and moved.")
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+
+# A stand-in for the yt-dlp executable that downloads nothing. It replays a recorded yt-dlp
+# transcript on stdout and writes a fake media file of a chosen size, so sessions can be run and
+# timed offline. The end to end benchmark puts it first on PATH as yt-dlp.
+#
+# Usage: fake_yt_dlp.py [yt-dlp options...] <url>
+#        fake_yt_dlp.py --record <transcript> [yt-dlp options...] <url>
+#
+# --record runs the real yt-dlp and saves its output with the time each line came out, as lines
+# of "@<seconds> <line>". Transcripts like the ones in logs/ have no times, and are replayed
+# evenly over FAKE_YT_DLP_SECONDS instead.
+#
+# Environment:
+#   FAKE_YT_DLP_TRANSCRIPT  transcript to replay, logs/dash_1018_fragments.log by default
+#   FAKE_YT_DLP_SECONDS     how long an untimed transcript takes to replay, 2 by default
+#   FAKE_YT_DLP_SPEED       how many times faster than recorded a timed transcript is replayed, 1 by default
+#   FAKE_YT_DLP_SIZE        size of the fake media file in bytes, 8 MiB by default
+#   FAKE_YT_DLP_REAL        the real yt-dlp, for --record
+
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+
+benchmark_directory = os.path.dirname(os.path.abspath(__file__))
+default_transcript = os.path.join(benchmark_directory, "logs", "dash_1018_fragments.log")
+timed_line_pattern = re.compile(r"^@(\d+(?:\.\d+)?) (.*)$")
+line_break_pattern = re.compile(r"\r\n|\r|\n")
+video_id_pattern = re.compile(r"[?&]v=([\w-]+)")
+# Output is flushed in batches at most this far apart, the way yt-dlp's writes reach a pipe
+batch_seconds = 0.005
+write_chunk_size = 1024 * 1024
+
+# Returns the value given after a command line option, or None
+def option_value(arguments, *names):
+    for name in names:
+        if name in arguments[:-1]:
+            return arguments[arguments.index(name) + 1]
+    return None
+
+# Returns the URL yt-dlp was asked to download, reading it from --load-info-json if given
+def requested_url(arguments):
+    info_path = option_value(arguments, "--load-info-json")
+    if info_path is not None:
+        with open(info_path, 'r') as f:
+            info = json.load(f)
+        return info.get("webpage_url") or info.get("id")
+    return arguments[-1]
+
+def video_id(url):
+    match = video_id_pattern.search(url)
+    return match.group(1) if match else url.rstrip("/").rsplit("/", 1)[-1]
+
+# Reads a transcript as (seconds from the start, line) pairs. Untimed lines are spread evenly over
+# FAKE_YT_DLP_SECONDS, timed ones are sped up by FAKE_YT_DLP_SPEED.
+def read_transcript(path):
+    with open(path, 'r', errors="replace") as f:
+        lines = line_break_pattern.split(f.read())
+    lines = [line for line in lines if line]
+    matches = [timed_line_pattern.match(line) for line in lines]
+    if lines and all(matches):
+        speed = float(os.environ.get("FAKE_YT_DLP_SPEED", "1"))
+        return [(float(match.group(1)) / speed, match.group(2)) for match in matches]
+    seconds = float(os.environ.get("FAKE_YT_DLP_SECONDS", "2"))
+    step = seconds / max(len(lines), 1)
+    return [(index * step, line) for index, line in enumerate(lines)]
+
+# Prints the info dict yt-dlp would for --dump-single-json, with the fake file's size
+def dump_info(url, size):
+    identifier = video_id(url)
+    print(json.dumps({
+        "id": identifier,
+        "title": f"Fake upload {identifier}",
+        "webpage_url": url,
+        "duration": 600,
+        "ext": "mp4",
+        "requested_formats": [{"format_id": "137", "filesize": size // 2}, {"format_id": "140", "filesize": size - size // 2}],
+    }))
+
+# Replays the transcript while writing the media file alongside it, a share of the file for every
+# line, then renames it the way yt-dlp does once the download is finished
+def replay(transcript, filename, size):
+    chunk = b"\0" * min(size, write_chunk_size) if size else b""
+    written = 0
+    started = time.monotonic()
+    with open(filename + ".part", 'wb') as f:
+        for index, (offset, line) in enumerate(transcript):
+            delay = offset - (time.monotonic() - started)
+            if delay > batch_seconds:
+                sys.stdout.flush()
+                time.sleep(delay)
+            sys.stdout.write(line + "\n")
+            target = size * (index + 1) // len(transcript)
+            while written < target:
+                written += f.write(chunk[:target - written])
+        while written < size:
+            written += f.write(chunk[:size - written])
+    sys.stdout.flush()
+    os.replace(filename + ".part", filename)
+
+# Runs the real yt-dlp and saves its output with the time each line came out
+def record(transcript_path, arguments):
+    command = [os.environ.get("FAKE_YT_DLP_REAL", "yt-dlp"), "--newline"] + arguments
+    started = time.monotonic()
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    with open(transcript_path, 'w') as f:
+        for raw_line in process.stdout:
+            offset = time.monotonic() - started
+            for line in line_break_pattern.split(raw_line.decode(errors="replace")):
+                if line:
+                    f.write(f"@{offset:.3f} {line}\n")
+                    print(line, flush=True)
+    return process.wait()
+
+def main():
+    arguments = sys.argv[1:]
+    if len(arguments) >= 2 and arguments[0] == "--record":
+        sys.exit(record(arguments[1], arguments[2:]))
+    if not arguments:
+        print("Usage: fake_yt_dlp.py [yt-dlp options...] <url>", file=sys.stderr)
+        sys.exit(2)
+
+    size = int(os.environ.get("FAKE_YT_DLP_SIZE", str(8 * 1024 * 1024)))
+    url = requested_url(arguments)
+    if "--dump-single-json" in arguments:
+        dump_info(url, size)
+        return
+
+    identifier = video_id(url)
+    archive = option_value(arguments, "--download-archive")
+    if archive is not None and os.path.exists(archive):
+        with open(archive, 'r') as f:
+            if f"youtube {identifier}" in f.read().splitlines():
+                print(f"[download] {identifier} has already been recorded in the archive", flush=True)
+                return
+
+    # Files go where yt-dlp would put them, the working directory unless -P says otherwise
+    directory = os.path.expanduser(option_value(arguments, "-P", "--paths") or ".")
+    os.makedirs(directory, exist_ok=True)
+    transcript = read_transcript(os.environ.get("FAKE_YT_DLP_TRANSCRIPT", default_transcript))
+    replay(transcript, os.path.join(directory, f"Fake upload [{identifier}].mp4"), size)
+
+    if archive is not None:
+        with open(archive, 'a') as f:
+            f.write(f"youtube {identifier}\n")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+# Replays recorded yt-dlp logs through the old and the new progress-line parsers and reports
+# how many lines per second each one gets through. The coalesced column is the ingest path the
+# suppressed panel uses, where progress lines are only parsed once per drawn frame.
+#
+# Usage: python3 benchmarks/parser_benchmark.py [--repeat N] [log files...]
+
+import importlib.util
+import glob
+import os
+import re
+import sys
+import time
+
+benchmark_directory = os.path.dirname(os.path.abspath(__file__))
+script_path = os.path.join(benchmark_directory, "..", "yt-dlp-sc.py")
+
+# Loads yt-dlp-sc.py as a module. The file name has dashes, so it can't be imported normally.
+def load_yt_dlp_sc():
+    spec = importlib.util.spec_from_file_location("yt_dlp_sc", script_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+# The parser as it was before the single-pass rewrite: five uncompiled searches per call,
+# called again by every formatter a line matches.
+item_number = "?"
+total_items = "?"
+
+def legacy_extract_download_details(line):
+    global item_number
+    global total_items
+    fragment_match = re.search(r"\(frag (\d+)/(\d+)\)", line)
+    eta_match = re.search(r"ETA (\d{2}:\d{2})", line)
+    speed_match = re.search(r"at\s+([~\d.]+[A-Za-z]+/s)", line)
+    size_match = re.search(r"of ~\s+([~\d.]+[A-Za-z]+)", line)
+    download_count = re.search(r"Downloading item (\d+) of (\d+)", line)
+
+    current_fragment = fragment_match.group(1) if fragment_match else "?"
+    total_fragment = fragment_match.group(2) if fragment_match else "?"
+    eta = eta_match.group(1) if eta_match else "N/A"
+    speed = speed_match.group(1) if speed_match else "N/A"
+    total_size = size_match.group(1) if size_match else "N/A"
+    pulled_item_number = download_count.group(1) if download_count else "?"
+    pulled_total_items = download_count.group(2) if download_count else "?"
+
+    if str.isdigit(pulled_item_number):
+        item_number = pulled_item_number
+    if str.isdigit(pulled_total_items):
+        total_items = pulled_total_items
+
+    return current_fragment, total_fragment, eta, speed, total_size, item_number, total_items
+
+def legacy_format_video_download_status(line):
+    current_fragment, total_fragment, eta, speed, total_size, item_number, total_items = legacy_extract_download_details(line)
+    if str.isdigit(f"{item_number}") and str.isdigit(f"{total_items}"):
+        return f"Downloading Video fragment {current_fragment}/{total_fragment} | ETA: {eta} at ~ {speed} | Video {item_number} of {total_items} size ~ {total_size}"
+    return f"Downloading Video fragment {current_fragment}/{total_fragment} | ETA: {eta} at ~ {speed} | Video size ~ {total_size}"
+
+def legacy_format_audio_download_status(line):
+    current_fragment, total_fragment, eta, speed, total_size, item_number, total_items = legacy_extract_download_details(line)
+    if str.isdigit(f"{item_number}") and str.isdigit(f"{total_items}"):
+        return f"Downloading Audio | ETA: {eta} at ~ {speed} | Audio {item_number} of {total_items} size ~ {total_size}"
+    return f"Downloading Audio | ETA: {eta} at ~ {speed} | Video size ~ {total_size}"
+
+def legacy_format_merging_status(line):
+    current_fragment, total_fragment, eta, speed, total_size, item_number, total_items = legacy_extract_download_details(line)
+    if str.isdigit(f"{item_number}") and str.isdigit(f"{total_items}"):
+        return f"Merging Video and Audio files for video {item_number} of {total_items}."
+    return f"Merging Video and Audio files"
+
+# Same branch structure as the old suppress loop, minus the rendering
+def legacy_parse_line(line):
+    status = None
+    if ("[download]" in line and "%" in line and "ETA" in line) or ("Downloading item" in line):
+        status = legacy_format_video_download_status(line)
+    if ("[download]" in line and "%" in line and "ETA" in line and not "frag" in line):
+        status = legacy_format_audio_download_status(line)
+    if "[Merger]" in line and "Merging" in line:
+        status = legacy_format_merging_status(line)
+    return status
+
+# Times one parser over the given lines, returning lines per second and the number of status updates
+def run_parser(parse, lines, repeat):
+    updates = 0
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for line in lines:
+            if parse(line) is not None:
+                updates += 1
+    elapsed = time.perf_counter() - start
+    return len(lines) * repeat / elapsed, updates // repeat
+
+def main():
+    arguments = sys.argv[1:]
+    repeat = 20
+    if len(arguments) >= 2 and arguments[0] == "--repeat":
+        repeat = int(arguments[1])
+        arguments = arguments[2:]
+    log_files = arguments or sorted(glob.glob(os.path.join(benchmark_directory, "logs", "*.log")))
+
+    yt_dlp_sc = load_yt_dlp_sc()
+    job = yt_dlp_sc.DownloadJob("https://www.youtube.com/watch?v=benchmark", 0)
+
+    def new_parse_line(line):
+        if yt_dlp_sc.update_job_from_line(job, line):
+            return job.status
+        return None
+
+    # Ingests every line, parsing the latest pending one every frame_lines lines as a frame would
+    frame_lines = 250
+    ingested = [0]
+    def coalesced_parse_line(line):
+        yt_dlp_sc.ingest_job_line(job, line)
+        ingested[0] += 1
+        if ingested[0] % frame_lines == 0:
+            yt_dlp_sc.flush_job_line(job)
+        return None
+
+    print(f"{'log':<32} {'lines':>7} {'old lines/s':>14} {'new lines/s':>14} {'speedup':>8} {'coalesced lines/s':>18}")
+    for log_file in log_files:
+        with open(log_file, 'r') as f:
+            lines = f.read().splitlines()
+        old_rate, old_updates = run_parser(legacy_parse_line, lines, repeat)
+        new_rate, new_updates = run_parser(new_parse_line, lines, repeat)
+        coalesced_rate, _ = run_parser(coalesced_parse_line, lines, repeat)
+        print(f"{os.path.basename(log_file):<32} {len(lines):>7} {old_rate:>14,.0f} {new_rate:>14,.0f} {new_rate / old_rate:>7.2f}x {coalesced_rate:>18,.0f}")
+        if old_updates != new_updates:
+            print(f"  note: old parser produced {old_updates} status updates, new parser {new_updates}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+# Checks that the queue takes one item from each source in turn: the videos of two playlists
+# queued one after the other, and links whose channels are only learned when prefetch resolves
+# them, must come out of the queue alternating between their sources. Exits with 1 if they don't,
+# so it works as a smoke test.
+#
+# Usage: python3 benchmarks/queue_order_check.py
+#
+# It runs against a throwaway home directory, so the user's options and queue are not touched,
+# and nothing goes over the network.
+
+import contextlib
+import importlib.util
+import os
+import shutil
+import sys
+import tempfile
+
+benchmark_directory = os.path.dirname(os.path.abspath(__file__))
+script_path = os.path.join(benchmark_directory, "..", "yt-dlp-sc.py")
+
+# Loads yt-dlp-sc.py as a module. The file name has dashes, so it can't be imported normally.
+def load_yt_dlp_sc():
+    spec = importlib.util.spec_from_file_location("yt_dlp_sc", script_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+# Returns the source of every waiting item, in the order the queue hands them out
+def queued_sources(yt_dlp_sc):
+    database = yt_dlp_sc.open_queue_database()
+    return [database.execute("SELECT source FROM queue WHERE id = ?", (item["id"],)).fetchone()["source"]
+            for item in yt_dlp_sc.queued_items()]
+
+# Returns True if no two items in a row have the same source, as long as another source still has items waiting
+def alternates(sources):
+    for index in range(1, len(sources)):
+        if sources[index] == sources[index - 1] and set(sources[index:]) != {sources[index]}:
+            return False
+    return True
+
+def check_expanded_playlists(yt_dlp_sc):
+    yt_dlp_sc.enqueue_links([f"https://www.youtube.com/watch?v=playlistA{number:02d}" for number in range(4)], 0, "playlist A")
+    yt_dlp_sc.enqueue_links([f"https://www.youtube.com/watch?v=playlistB{number:02d}" for number in range(3)], 0, "playlist B")
+    return queued_sources(yt_dlp_sc)
+
+def check_prefetched_channels(yt_dlp_sc):
+    channels = ["X", "X", "X", "Y", "X", "Y"]
+    links = [f"https://www.youtube.com/watch?v=channel{channel}{number:02d}" for number, channel in enumerate(channels)]
+    yt_dlp_sc.enqueue_links(links)
+    yt_dlp_sc.record_link_details({link: {"channel_id": channel, "duration": 60} for link, channel in zip(links, channels)})
+    return queued_sources(yt_dlp_sc)
+
+def main():
+    failed = False
+    for check in (check_expanded_playlists, check_prefetched_channels):
+        home = tempfile.mkdtemp(prefix="yt-dlp-sc-check-")
+        original_home = os.environ.get("HOME")
+        try:
+            os.environ["HOME"] = home
+            os.makedirs(os.path.join(home, ".config"))
+            yt_dlp_sc = load_yt_dlp_sc()
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                yt_dlp_sc.write_default_options()
+                sources = check(yt_dlp_sc)
+        finally:
+            if original_home is not None:
+                os.environ["HOME"] = original_home
+            shutil.rmtree(home, ignore_errors=True)
+        ok = alternates(sources)
+        failed = failed or not ok
+        print(f"{check.__name__:<26} {'ok' if ok else 'FAILED'}  {', '.join(sources)}")
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+# Times how long yt-dlp-sc takes to start and answer commands that do no real work, by running
+# it as a fresh process again and again, and lists the imports that take longest for -v. Run it
+# as the code grows, so startup latency doesn't creep up unnoticed.
+#
+# Usage: python3 benchmarks/startup_benchmark.py [--repeat N] [commands...]
+#
+# Commands run against a throwaway home directory, so the user's options and queue are not touched.
+
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+benchmark_directory = os.path.dirname(os.path.abspath(__file__))
+script_path = os.path.join(benchmark_directory, "..", "yt-dlp-sc.py")
+default_commands = ["-v", "-h", "show", "-r 99"]
+
+# Runs a command once, returning its wall time in seconds
+def time_run(command, environment):
+    start = time.perf_counter()
+    subprocess.run(command, env=environment, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+# Returns the modules that took longest to import for -v, as (cumulative, own, name) in
+# microseconds, and the total time spent importing
+def slowest_imports(environment, count=10):
+    result = subprocess.run([sys.executable, "-X", "importtime", script_path, "-v"], env=environment,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    imports = []
+    total = 0
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        own, cumulative, module = line[len("import time:"):].split("|")
+        # Nested imports are indented, and already counted in their parent's cumulative time
+        if not module[1:].startswith(" "):
+            total += int(cumulative)
+        imports.append((int(cumulative), int(own), module.strip()))
+    return sorted(imports, reverse=True)[:count], total
+
+def print_timings(name, timings):
+    print(f"{name:<12} {len(timings):>5} {min(timings) * 1000:>8.1f} {statistics.median(timings) * 1000:>10.1f} {max(timings) * 1000:>8.1f}")
+
+def main():
+    arguments = sys.argv[1:]
+    repeat = 20
+    if len(arguments) >= 2 and arguments[0] == "--repeat":
+        repeat = int(arguments[1])
+        arguments = arguments[2:]
+    commands = arguments or default_commands
+
+    with tempfile.TemporaryDirectory() as home:
+        environment = dict(os.environ, HOME=home)
+        os.makedirs(os.path.join(home, ".config"))
+        # The first run creates the options file and the queue database, so it is not counted
+        time_run([sys.executable, script_path, "show"], environment)
+
+        print(f"{'command':<12} {'runs':>5} {'min ms':>8} {'median ms':>10} {'max ms':>8}")
+        # The interpreter on its own, the floor for every command
+        print_timings("(python)", [time_run([sys.executable, "-c", "pass"], environment) for _ in range(repeat)])
+        for command in commands:
+            print_timings(command, [time_run([sys.executable, script_path] + command.split(), environment) for _ in range(repeat)])
+
+        imports, total = slowest_imports(environment)
+        print(f"\nSlowest imports for -v, {total / 1000:.1f} ms in total:")
+        for cumulative, own, module in imports:
+            print(f"  {module:<32} {cumulative / 1000:>8.1f} ms ({own / 1000:.1f} ms own)")
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,34 @@
 #!/usr/bin/env python3
 
-from rich.live import Live
-from rich.panel import Panel
+from urllib.parse import urlparse, urlunparse, parse_qsl, urlencode
 import os
 import sys
-import subprocess
 import configparser
 import shutil
-import requests
 import re
+import threading
+import json
+import time
+import importlib
+import hashlib
+import sqlite3
+import contextlib
+import errno
+import random
+import signal
+import socket
+
+# Imported on first use by the commands that need them, see load_session_modules and get_http_session,
+# so that -v, -h and editing the queue or options don't wait for them
+asyncio = None
+subprocess = None
+requests = None
+Live = None
+Panel = None
+Table = None
+ThreadPoolExecutor = None
+wait = None
+FIRST_COMPLETED = None
 
 # Text colors
 class bcolors:
@@ -24,6 +44,13 @@ class bcolors:
 # Define the path to the configuration and queue files
 config_file_path = os.path.expanduser("~/.config/yt-dlp-sc/options.conf")
 queue_file_path = os.path.expanduser("~/.config/yt-dlp-sc/queue.txt")
+queue_database_path = os.path.expanduser("~/.config/yt-dlp-sc/queue.db")
+info_cache_directory = os.path.expanduser("~/.config/yt-dlp-sc/info")
+archive_directory = os.path.expanduser("~/.config/yt-dlp-sc/archive")
+ping_cache_file_path = os.path.expanduser("~/.config/yt-dlp-sc/ping_cache.json")
+fragment_tuning_file_path = os.path.expanduser("~/.config/yt-dlp-sc/fragment_tuning.json")
+event_log_file_path = os.path.expanduser("~/.config/yt-dlp-sc/events.jsonl")
+daemon_socket_path = os.path.expanduser("~/.config/yt-dlp-sc/daemon.sock")
 config = configparser.ConfigParser()
 
 # Initialize global variables
@@ -35,7 +62,211 @@ yt_dlp_options = ""
 suppress_output = ""
 debug = "True"
 pretty = ""
+max_jobs_per_host = 0
+preflight_jobs = 8
+ping_cache_ttl = 3600
+ui_refresh_rate = 4
+engine = "subprocess"
+prefetch_jobs = 4
+info_cache_ttl = 14400
+mover_jobs = 2
+temp_min_free_mb = 2048
+rate_limit = "0"
+rate_schedule = ""
+tune_fragments = False
+max_concurrent_fragments = 16
+metrics_file = ""
+max_retries = 3
+retry_backoff = 30
+verify_moves = False
 queue = []
+queue_database = None
+queue_lock = threading.RLock()
+queue_schema = """
+CREATE TABLE IF NOT EXISTS queue (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    link TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'queued',
+    priority INTEGER NOT NULL DEFAULT 0,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    claimed_by INTEGER,
+    added_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS queue_order ON queue (status, priority DESC, id);
+"""
+# Schema changes made after the first version of queue.db. PRAGMA user_version counts how many
+# of them a database has had, and open_queue_database applies the rest in order.
+queue_migrations = [
+    # Deduplicate waiting links on a 64 bit hash of the canonical link instead of the full text.
+    # Links already queued are rewritten to their canonical form, and ones that turn out to be
+    # the same link are marked removed.
+    """
+    ALTER TABLE queue ADD COLUMN link_hash INTEGER;
+    DROP INDEX IF EXISTS queue_active_link;
+    UPDATE queue SET link = normalize_link(link);
+    UPDATE queue SET link_hash = link_hash(link);
+    UPDATE queue SET status = 'removed' WHERE status IN ('queued', 'downloading') AND id NOT IN (
+        SELECT MIN(id) FROM queue WHERE status IN ('queued', 'downloading') GROUP BY link_hash
+    );
+    CREATE UNIQUE INDEX queue_active_link_hash ON queue (link_hash) WHERE status IN ('queued', 'downloading');
+    """,
+    # Session journal, one row per state change of a job, so a killed session can be resumed
+    """
+    CREATE TABLE journal (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        item_id INTEGER NOT NULL,
+        state TEXT NOT NULL,
+        directory TEXT,
+        pid INTEGER,
+        at REAL NOT NULL
+    );
+    CREATE INDEX journal_item ON journal (item_id, id);
+    """,
+    # Permanent download archive, keyed like yt-dlp's archive file: "<extractor> <video id>"
+    """
+    CREATE TABLE archive (key TEXT PRIMARY KEY) WITHOUT ROWID;
+    """,
+    # Failed downloads wait until not_before to be retried, and keep the reason they failed. Ones
+    # that are not retried any more stay in the queue as failed, which is the failed list.
+    """
+    ALTER TABLE queue ADD COLUMN not_before REAL NOT NULL DEFAULT 0;
+    ALTER TABLE queue ADD COLUMN last_error TEXT;
+    """,
+    # Each item's source, the playlist it was expanded from or its channel, and its duration once
+    # known. queue_schedule gives every waiting item the turn of its source it comes up in,
+    # counting the items of the source started since it was queued, so the queue can take one
+    # item from each source in turn.
+    """
+    ALTER TABLE queue ADD COLUMN source TEXT;
+    ALTER TABLE queue ADD COLUMN duration REAL;
+    CREATE INDEX queue_source ON queue (source, updated_at) WHERE source IS NOT NULL;
+    CREATE VIEW queue_schedule AS SELECT *, ROW_NUMBER() OVER (
+        PARTITION BY status, priority, COALESCE(source, id) ORDER BY id
+    ) + (
+        SELECT COUNT(*) FROM queue AS started WHERE started.source = queue.source
+            AND started.status IN ('downloading', 'done', 'failed') AND started.updated_at >= queue.added_at
+    ) AS lane_round FROM queue WHERE status IN ('queued', 'downloading');
+    """,
+    # Subscribed channels and playlists. watermark holds the ids of the newest videos seen at the
+    # last sync, newest first, so the next one can stop listing as soon as it reaches one of them.
+    """
+    CREATE TABLE subscriptions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        url TEXT NOT NULL UNIQUE,
+        priority INTEGER NOT NULL DEFAULT 0,
+        backfill INTEGER NOT NULL DEFAULT 1,
+        watermark TEXT NOT NULL DEFAULT '[]',
+        synced_at REAL,
+        added_at REAL NOT NULL
+    );
+    """,
+    # Each waiting item's turn is stored as lane_round when it is queued instead of being counted
+    # by queue_schedule on every read, so the next item comes straight off the queue_lane index.
+    # Items already waiting get the turns queue_schedule gave them.
+    """
+    CREATE TEMP TABLE lane_rounds (id INTEGER PRIMARY KEY, lane_round INTEGER NOT NULL);
+    INSERT INTO lane_rounds SELECT id, lane_round FROM queue_schedule;
+    ALTER TABLE queue ADD COLUMN lane_round INTEGER NOT NULL DEFAULT 0;
+    UPDATE queue SET lane_round = (SELECT lane_round FROM lane_rounds WHERE lane_rounds.id = queue.id)
+        WHERE id IN (SELECT id FROM lane_rounds);
+    DROP TABLE lane_rounds;
+    DROP VIEW queue_schedule;
+    DROP INDEX queue_source;
+    CREATE INDEX queue_lane ON queue (status, priority DESC, lane_round, duration IS NULL, duration, id);
+    CREATE INDEX queue_source_lane ON queue (source, status, priority, lane_round) WHERE source IS NOT NULL;
+    """,
+    # The first schema's unique index on the full link text was recreated on every open after
+    # the first migration had dropped it, and is dropped for good now that the schema has lost it
+    """
+    DROP INDEX IF EXISTS queue_active_link;
+    """,
+    # Failed moves are counted apart from download attempts, so a link that needed every download
+    # retry still gets its move retries
+    """
+    ALTER TABLE queue ADD COLUMN move_attempts INTEGER NOT NULL DEFAULT 0;
+    """,
+]
+# Download order: higher priority first, then one item from each source in turn, so a long
+# playlist doesn't hold up the links added after it, then the shortest known video first.
+# Links with no known source are a source of their own. The turn is the item's lane_round.
+queue_schedule_order = "priority DESC, lane_round, duration IS NULL, duration, id"
+priority_levels = {"low": -1, "normal": 0, "high": 1}
+watermark_size = 20
+youtube_channel_pattern = re.compile(r"^/(@[^/]+|channel/[^/]+|c/[^/]+|user/[^/]+)$")
+youtube_channel_tab_pattern = re.compile(r"^/(@[^/]+|channel/[^/]+|c/[^/]+|user/[^/]+)(/(videos|shorts|streams))?$")
+archive_batch_size = 100000
+journal_retention = 7 * 24 * 3600
+retry_backoff_max = 3600
+# yt-dlp errors that won't go away by trying again. Anything else, like HTTP 5xx errors,
+# throttling and timeouts, is retried up to max_retries times.
+permanent_error_pattern = re.compile(
+    r"Private video|Video unavailable|has been removed|account associated with this video has been terminated"
+    r"|not available in your country|geo.?restrict|blocked it in your country|confirm your age|members.only"
+    r"|Join this channel|Unsupported URL|Requested format is not available|HTTP Error (?:400|401|404|410)\b"
+    r"|more than the disk of .* holds",
+    re.IGNORECASE,
+)
+move_chunk_size = 64 * 1024 * 1024
+verify_chunk_size = 8 * 1024 * 1024
+copy_fallback_errors = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP}
+unfinished_file_pattern = re.compile(r"\.(part|ytdl|temp|moving)$|\.part-Frag\d+")
+youtube_hosts = {"youtube.com", "www.youtube.com", "m.youtube.com", "music.youtube.com", "youtu.be", "www.youtube-nocookie.com"}
+tracking_parameters = {"si", "feature", "pp", "fbclid", "gclid", "igshid", "ab_channel"}
+youtube_video_id_pattern = re.compile(r"^[A-Za-z0-9_-]{11}$")
+output_event_queue_size = 256
+line_break_pattern = re.compile(rb"\r\n?|\n")
+progress_line_pattern = re.compile(
+    r"\[download\]\s+(?P<percent>[\d.]+)%"
+    r"(?:\s+of\s+~?\s*(?P<size>[\d.]+[A-Za-z]+))?"
+    r"(?:\s+at\s+(?P<speed>[~\d.]+[A-Za-z]+/s|Unknown B/s))?"
+    r"(?:\s+ETA\s+(?P<eta>\d{2}:\d{2}(?::\d{2})?|Unknown))?"
+    r"(?:\s+\(frag\s+(?P<fragment>\d+)/(?P<total_fragments>\d+)\))?"
+)
+download_item_pattern = re.compile(r"Downloading item (\d+) of (\d+)")
+http_session = None
+ping_cache = None
+ping_cache_lock = threading.Lock()
+yt_dlp = None
+embedded_params = None
+embedded_workers = []
+embedded_workers_lock = threading.Lock()
+bandwidth_governor = None
+rate_pattern = re.compile(r"^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)(?:i?B)?\s*$", re.IGNORECASE)
+rate_window_pattern = re.compile(r"^\s*(\d{1,2}):(\d{2})\s*-\s*(\d{1,2}):(\d{2})\s*=\s*(.+)$")
+concurrent_fragments_pattern = re.compile(r"(?:^|\s)(?:-N|--concurrent-fragments)\s+(\d+)")
+fragment_tuning = None
+fragment_tuning_lock = threading.Lock()
+fragment_tuning_ttl = 7 * 24 * 3600
+fragment_tuning_min_samples = 5
+event_log_lock = threading.Lock()
+phase_timings = None
+daemon_timeout = 10
+disk_space_poll_interval = 10
+daemon_poll_interval = 5
+rate_check_interval = 5
+profile_phases = ["queue check", "url check", "url check (cached)", "prefetch", "yt-dlp startup", "extraction", "download", "merge", "job", "move", "session"]
+session_metrics = None
+metric_definitions = {
+    "yt_dlp_sc_session_start_time_seconds": ("gauge", "When the session started, in seconds since the epoch."),
+    "yt_dlp_sc_active_downloads": ("gauge", "Downloads running right now."),
+    "yt_dlp_sc_probes_total": ("counter", "URL checks sent, by result."),
+    "yt_dlp_sc_probe_seconds_total": ("counter", "Time spent on URL checks."),
+    "yt_dlp_sc_extractions_total": ("counter", "Links prefetched, by result."),
+    "yt_dlp_sc_extraction_seconds_total": ("counter", "Time spent prefetching links."),
+    "yt_dlp_sc_downloads_total": ("counter", "Downloads that ended, by host and result."),
+    "yt_dlp_sc_download_seconds_total": ("counter", "Time spent downloading, by host."),
+    "yt_dlp_sc_download_startup_seconds_total": ("counter", "Time from starting a download to its first progress, by host."),
+    "yt_dlp_sc_merge_seconds_total": ("counter", "Time spent merging formats, by host."),
+    "yt_dlp_sc_downloaded_bytes_total": ("counter", "Bytes downloaded, by host."),
+    "yt_dlp_sc_fragments_total": ("counter", "Fragments downloaded, by host."),
+    "yt_dlp_sc_peak_speed_bytes": ("gauge", "Highest download speed seen in the session, by host."),
+    "yt_dlp_sc_retries_total": ("counter", "Failed downloads put back in the queue to be retried, by host."),
+    "yt_dlp_sc_failed_total": ("counter", "Downloads moved to the failed list, by host."),
+    "yt_dlp_sc_moves_total": ("counter", "Downloads moved to the final directory, by result."),
+    "yt_dlp_sc_move_seconds_total": ("counter", "Time spent moving files to the final directory."),
+    "yt_dlp_sc_moved_bytes_total": ("counter", "Bytes moved to the final directory."),
+}
 default_options = """[yt-dlp]
 download_directory=~/Downloads
 temp_download_directory=~/Downloads/yt-dlp-sc
@@ -43,7 +274,24 @@ yt_dlp_options=-f bv*[height<=1080][ext=mp4]+ba*[ext=m4a] -N 2
 use_temp_folder=False
 suppress_output=True
 debug=False
-pretty=True"""
+pretty=True
+max_jobs_per_host=0
+preflight_jobs=8
+ping_cache_ttl=3600
+ui_refresh_rate=4
+engine=subprocess
+prefetch_jobs=4
+info_cache_ttl=14400
+mover_jobs=2
+temp_min_free_mb=2048
+rate_limit=0
+rate_schedule=
+tune_fragments=False
+max_concurrent_fragments=16
+metrics_file=
+max_retries=3
+retry_backoff=30
+verify_moves=False"""
 
 def create_yt_dlp_sc_folder():
     if os.access(os.path.expanduser("~/.config"), os.W_OK) and not os.path.isdir(os.path.expanduser("~/.config/yt-dlp-sc/")):
@@ -164,24 +412,28 @@ def load_options():
     global suppress_output
     global debug
     global pretty
-
-    # Checks if the config_file_path exists, and if it is not empty
+    global max_jobs_per_host
+    global preflight_jobs
+    global ping_cache_ttl
+    global ui_refresh_rate
+    global engine
+    global prefetch_jobs
+    global info_cache_ttl
+    global mover_jobs
+    global temp_min_free_mb
+    global rate_limit
+    global rate_schedule
+    global tune_fragments
+    global max_concurrent_fragments
+    global metrics_file
+    global max_retries
+    global retry_backoff
+    global verify_moves
+
+    # Reads the options file once. A file that lost its [yt-dlp] header gets it back first.
     if os.path.exists(config_file_path) and not os.stat(config_file_path).st_size == 0:
         if not check_header(config_file_path):
             prepend_line_to_file(config_file_path, "[yt-dlp]")
-        else:
-            config.read(config_file_path)
-            download_directory = os.path.expanduser(config.get('yt-dlp', 'download_directory'))
-            temp_download_directory = os.path.expanduser(config.get('yt-dlp', 'temp_download_directory'))
-            yt_dlp_options = config.get('yt-dlp', 'yt_dlp_options')
-            use_temp_folder = config.getboolean('yt-dlp', 'use_temp_folder')
-            suppress_output = config.getboolean('yt-dlp', 'suppress_output')
-            debug = config.getboolean('yt-dlp', 'debug')
-            pretty = config.getboolean('yt-dlp', 'pretty')
-
-    # Check if the options file is already loaded with defaults.
-    if is_same_as_default(config_file_path):
-        print(is_same_as_default(config_file_path))
         config.read(config_file_path)
         download_directory = os.path.expanduser(config.get('yt-dlp', 'download_directory'))
         temp_download_directory = os.path.expanduser(config.get('yt-dlp', 'temp_download_directory'))
@@ -190,25 +442,28 @@ def load_options():
         suppress_output = config.getboolean('yt-dlp', 'suppress_output')
         debug = config.getboolean('yt-dlp', 'debug')
         pretty = config.getboolean('yt-dlp', 'pretty')
-
-    # Check if the configuration file exists but is only blank/whitespace. Writes defaults if it is.
+        max_jobs_per_host = config.getint('yt-dlp', 'max_jobs_per_host', fallback=0)
+        preflight_jobs = config.getint('yt-dlp', 'preflight_jobs', fallback=8)
+        ping_cache_ttl = config.getint('yt-dlp', 'ping_cache_ttl', fallback=3600)
+        ui_refresh_rate = config.getint('yt-dlp', 'ui_refresh_rate', fallback=4)
+        engine = config.get('yt-dlp', 'engine', fallback="subprocess")
+        prefetch_jobs = config.getint('yt-dlp', 'prefetch_jobs', fallback=4)
+        info_cache_ttl = config.getint('yt-dlp', 'info_cache_ttl', fallback=14400)
+        mover_jobs = config.getint('yt-dlp', 'mover_jobs', fallback=2)
+        temp_min_free_mb = config.getint('yt-dlp', 'temp_min_free_mb', fallback=2048)
+        rate_limit = config.get('yt-dlp', 'rate_limit', fallback="0")
+        rate_schedule = config.get('yt-dlp', 'rate_schedule', fallback="")
+        tune_fragments = config.getboolean('yt-dlp', 'tune_fragments', fallback=False)
+        max_concurrent_fragments = config.getint('yt-dlp', 'max_concurrent_fragments', fallback=16)
+        metrics_file = config.get('yt-dlp', 'metrics_file', fallback="")
+        max_retries = config.getint('yt-dlp', 'max_retries', fallback=3)
+        retry_backoff = config.getint('yt-dlp', 'retry_backoff', fallback=30)
+        verify_moves = config.getboolean('yt-dlp', 'verify_moves', fallback=False)
+
+    # Check if the configuration file is missing or only blank/whitespace. Writes defaults if it is.
     elif is_file_blank(config_file_path):
         write_default_options()
 
-# Reads and loads the queue from the queue file into active queue memory
-def load_queue():
-    global queue
-    if os.path.exists(queue_file_path):
-        with open(queue_file_path, 'r') as f:
-            queue = [line.strip() for line in f if line.strip()]
-    elif not os.path.exists(queue_file_path):
-        print(f"{bcolors.ERROR}Queue file not found,{bcolors.ENDC} generating empty queue.")
-        with open(queue_file_path, 'w') as f:
-            pass
-    else:
-        if debug:
-            print(f"{bcolors.ERROR}DEBUG Error 10:{bcolors.ENDC} Error determining queue file status.")
-
 # Saves the updated set_temp_folder to the options file
 def set_temp_directory_option(temp_folder_option):
     global use_temp_folder
@@ -311,6 +566,16 @@ def set_yt_dlp_options(options):
     save_config()
     print(f"yt-dlp options set to: {yt_dlp_options}")
 
+# Saves the download engine option to the options file
+def set_engine(engine_option):
+    global engine
+    if engine_option.lower() == "subprocess" or engine_option.lower() == "embedded":
+        engine = engine_option.lower()
+        save_config()
+        print(f"Download engine is now {bcolors.COMPLETED}{engine}{bcolors.ENDC}.")
+    else:
+        print(f"Usage: -e/--engine <subprocess|embedded>")
+
 # Saves the updated config to the config file
 def save_config():
     with open(config_file_path, 'w') as f:
@@ -322,34 +587,562 @@ def save_config():
         f.write(f"suppress_output={suppress_output}\n")
         f.write(f"debug={debug}\n")
         f.write(f"pretty={pretty}\n")
+        f.write(f"max_jobs_per_host={max_jobs_per_host}\n")
+        f.write(f"preflight_jobs={preflight_jobs}\n")
+        f.write(f"ping_cache_ttl={ping_cache_ttl}\n")
+        f.write(f"ui_refresh_rate={ui_refresh_rate}\n")
+        f.write(f"engine={engine}\n")
+        f.write(f"prefetch_jobs={prefetch_jobs}\n")
+        f.write(f"info_cache_ttl={info_cache_ttl}\n")
+        f.write(f"mover_jobs={mover_jobs}\n")
+        f.write(f"temp_min_free_mb={temp_min_free_mb}\n")
+        f.write(f"rate_limit={rate_limit}\n")
+        f.write(f"rate_schedule={rate_schedule}\n")
+        f.write(f"tune_fragments={tune_fragments}\n")
+        f.write(f"max_concurrent_fragments={max_concurrent_fragments}\n")
+        f.write(f"metrics_file={metrics_file}\n")
+        f.write(f"max_retries={max_retries}\n")
+        f.write(f"retry_backoff={retry_backoff}\n")
+        f.write(f"verify_moves={verify_moves}\n")
+
+# Opens the queue database, creating it on first use and importing an old queue.txt into it once
+def open_queue_database():
+    global queue_database
+    if queue_database is None:
+        queue_database = sqlite3.connect(queue_database_path, timeout=10, isolation_level=None, check_same_thread=False)
+        queue_database.row_factory = sqlite3.Row
+        queue_database.execute("PRAGMA journal_mode=WAL")
+        queue_database.execute("PRAGMA synchronous=NORMAL")
+        queue_database.create_function("link_hash", 1, link_hash, deterministic=True)
+        queue_database.create_function("normalize_link", 1, normalize_link, deterministic=True)
+        queue_database.executescript(queue_schema)
+        migrate_queue_database(queue_database)
+        import_queue_file()
+    return queue_database
+
+# Applies the schema changes a queue database has not had yet
+def migrate_queue_database(database):
+    version = database.execute("PRAGMA user_version").fetchone()[0]
+    for migration in queue_migrations[version:]:
+        version += 1
+        database.executescript(f"BEGIN IMMEDIATE; {migration}; PRAGMA user_version = {version}; COMMIT;")
+
+# Returns a 64 bit hash of a link, used as the queue's duplicate index key
+def link_hash(link):
+    return int.from_bytes(hashlib.sha1(link.encode()).digest()[:8], "big", signed=True)
+
+# Rewrites a link to one canonical form, so the same video added in different ways is only
+# queued once. Youtube video links become www.youtube.com/watch?v=<id>, and tracking
+# parameters are dropped from every link.
+def normalize_link(link):
+    link = link.strip()
+    parsed = urlparse(link)
+    if not parsed.scheme or not parsed.hostname:
+        return link
+    parameters = [(key, value) for key, value in parse_qsl(parsed.query, keep_blank_values=True)
+                  if key not in tracking_parameters and not key.startswith("utm_")]
+
+    if parsed.hostname in youtube_hosts:
+        values = dict(parameters)
+        path_parts = [part for part in parsed.path.split("/") if part]
+        video_id = None
+        if parsed.hostname == "youtu.be" and path_parts:
+            video_id = path_parts[0]
+        elif parsed.path == "/watch":
+            video_id = values.get("v")
+        elif len(path_parts) >= 2 and path_parts[0] in ("shorts", "live", "embed", "v"):
+            video_id = path_parts[1]
+
+        if video_id and youtube_video_id_pattern.match(video_id):
+            # A playlist in a watch link makes yt-dlp download the playlist, so it is kept
+            if values.get("list"):
+                return f"https://www.youtube.com/watch?v={video_id}&list={values['list']}"
+            return f"https://www.youtube.com/watch?v={video_id}"
+        if parsed.path == "/playlist" and values.get("list"):
+            return f"https://www.youtube.com/playlist?list={values['list']}"
+        return urlunparse(("https", "www.youtube.com", parsed.path.rstrip("/") or "/", "", urlencode(parameters), ""))
+
+    return urlunparse((parsed.scheme.lower(), parsed.netloc.lower(), parsed.path, parsed.params, urlencode(parameters), ""))
+
+# Runs the statements in the with block as one write transaction
+@contextlib.contextmanager
+def queue_transaction():
+    database = open_queue_database()
+    with queue_lock:
+        database.execute("BEGIN IMMEDIATE")
+        try:
+            yield database
+        except BaseException:
+            database.execute("ROLLBACK")
+            raise
+        database.execute("COMMIT")
+
+# Moves the links of an old queue.txt into the database, then renames the file so this only happens once
+def import_queue_file():
+    if not os.path.exists(queue_file_path):
+        return
+    with open(queue_file_path, 'r') as f:
+        links = [line.strip() for line in f if line.strip()]
+    added = enqueue_links(links)
+    os.replace(queue_file_path, queue_file_path + ".imported")
+    if links:
+        print(f"Imported {added} links from {queue_file_path} into the queue database.")
+
+# Adds links to the queue in one transaction, in their canonical form. Links already waiting in
+# the queue, or repeated in the batch, are skipped, but move up to the given priority if it is
+# higher than theirs. Returns how many were added. source and durations, by canonical link, are
+# stored for the scheduler when they are known.
+def enqueue_links(links, priority=0, source=None, durations=None):
+    now = time.time()
+    with queue_transaction() as database:
+        lane_round = next_lane_round(database, priority, source)
+        rows = []
+        for link in links:
+            link = normalize_link(link)
+            rows.append((link, link_hash(link), priority, source, (durations or {}).get(link), lane_round, now, now))
+            if source is not None:
+                lane_round += 1
+        before = database.total_changes
+        database.executemany(
+            "INSERT OR IGNORE INTO queue (link, link_hash, priority, source, duration, lane_round, added_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            rows,
+        )
+        added = database.total_changes - before
+        # Raised items join the current turn of their new priority
+        raised_round = lowest_lane_round(database, priority)
+        database.executemany(
+            "UPDATE queue SET priority = ?, lane_round = ?, updated_at = ? WHERE link_hash = ? AND status = 'queued' AND priority < ?",
+            [(priority, raised_round, now, row[1], priority) for row in rows],
+        )
+        # Links that were already queued keep the time they were first added
+        queued = database.execute("SELECT id, link FROM queue WHERE added_at = ?", (now,)).fetchall() if added else []
+    write_events([{"time": round(now, 3), "event": "queued", "item_id": row["id"], "link": row["link"], "priority": priority} for row in queued])
+    return added
+
+# Returns the turn the waiting items of a priority have got to, 1 if none are waiting
+def lowest_lane_round(database, priority):
+    (lane_round,) = database.execute(
+        "SELECT MIN(lane_round) FROM queue WHERE status = 'queued' AND priority = ?", (priority,)
+    ).fetchone()
+    return lane_round or 1
+
+# Returns the turn a new item of a source comes up in. New items join the turn the queue has got
+# to, and a source's items take one turn each after the ones it already has waiting.
+def next_lane_round(database, priority, source):
+    lane_round = lowest_lane_round(database, priority)
+    if source is not None:
+        (last,) = database.execute(
+            "SELECT MAX(lane_round) FROM queue WHERE source = ? AND status = 'queued' AND priority = ?", (source, priority)
+        ).fetchone()
+        lane_round = max(lane_round, (last or 0) + 1)
+    return lane_round
+
+# Reads the links that are waiting or downloading into active queue memory, in download order
+def load_queue():
+    global queue
+    rows = open_queue_database().execute(
+        f"SELECT link FROM queue WHERE status IN ('queued', 'downloading') ORDER BY {queue_schedule_order}"
+    ).fetchall()
+    queue = [row["link"] for row in rows]
+    return queue
+
+# Returns the id, link and retry time of every item waiting to be downloaded, in download order
+def queued_items():
+    return [dict(row) for row in open_queue_database().execute(
+        f"SELECT id, link, not_before FROM queue WHERE status = 'queued' ORDER BY {queue_schedule_order}"
+    )]
+
+# Marks a waiting item as downloading by this process. Returns False if another process got it first.
+def claim_queue_item(item_id):
+    with queue_transaction() as database:
+        cursor = database.execute(
+            "UPDATE queue SET status = 'downloading', attempts = attempts + 1, claimed_by = ?, updated_at = ? WHERE id = ? AND status = 'queued' AND not_before <= ?",
+            (os.getpid(), time.time(), item_id, time.time()),
+        )
+        return cursor.rowcount == 1
+
+# Claims the next waiting item and returns it, or None if nothing is waiting. Items waiting to
+# be retried are left until their time comes.
+def claim_next_queue_item():
+    with queue_transaction() as database:
+        row = database.execute(
+            f"SELECT id, link FROM queue WHERE status = 'queued' AND not_before <= ? ORDER BY {queue_schedule_order} LIMIT 1",
+            (time.time(),),
+        ).fetchone()
+        if row is None:
+            return None
+        database.execute(
+            "UPDATE queue SET status = 'downloading', attempts = attempts + 1, claimed_by = ?, updated_at = ? WHERE id = ?",
+            (os.getpid(), time.time(), row["id"]),
+        )
+        return row
+
+# Records how a claimed item ended: done, removed or failed
+def finish_queue_item(item_id, status="done"):
+    with queue_transaction() as database:
+        database.execute(
+            "UPDATE queue SET status = ?, claimed_by = NULL, updated_at = ? WHERE id = ?",
+            (status, time.time(), item_id),
+        )
+        append_journal(database, item_id, status)
+
+# Returns the earliest time an item waiting to be retried can be claimed, or None if none is waiting
+def next_retry_time():
+    return open_queue_database().execute(
+        "SELECT MIN(not_before) FROM queue WHERE status = 'queued' AND not_before > ?", (time.time(),)
+    ).fetchone()[0]
+
+# Returns how many times an item has been claimed for downloading
+def queue_item_attempts(item_id):
+    row = open_queue_database().execute("SELECT attempts FROM queue WHERE id = ?", (item_id,)).fetchone()
+    return row["attempts"] if row else 0
+
+# Returns how many times an item's files failed to be moved
+def queue_item_move_attempts(item_id):
+    row = open_queue_database().execute("SELECT move_attempts FROM queue WHERE id = ?", (item_id,)).fetchone()
+    return row["move_attempts"] if row else 0
+
+# Records a failed move with the reason, like fail_queue_item, and counts it. The claim that picks
+# the item up again only moves its files, so it is taken off the download attempts in advance.
+def fail_queue_item_move(item_id, reason, retry_at=None):
+    with queue_transaction() as database:
+        database.execute(
+            "UPDATE queue SET status = ?, claimed_by = NULL, not_before = ?, last_error = ?, move_attempts = move_attempts + 1, attempts = attempts - ?, updated_at = ? WHERE id = ?",
+            ("queued" if retry_at else "failed", retry_at or 0, reason, 1 if retry_at else 0, time.time(), item_id),
+        )
+        append_journal(database, item_id, "retrying" if retry_at else "failed")
+
+# Records a failed download with the reason. With retry_at the item goes back in the queue and
+# is not claimed before then, otherwise it is moved to the failed list.
+def fail_queue_item(item_id, reason, retry_at=None):
+    with queue_transaction() as database:
+        database.execute(
+            "UPDATE queue SET status = ?, claimed_by = NULL, not_before = ?, last_error = ?, updated_at = ? WHERE id = ?",
+            ("queued" if retry_at else "failed", retry_at or 0, reason, time.time(), item_id),
+        )
+        append_journal(database, item_id, "retrying" if retry_at else "failed")
+
+# Returns the items on the failed list, oldest failure first
+def failed_items():
+    return open_queue_database().execute(
+        "SELECT id, link, attempts, last_error, updated_at FROM queue WHERE status = 'failed' ORDER BY updated_at, id"
+    ).fetchall()
+
+# Puts items on the failed list back in the queue with their attempts reset, the given ids or
+# all of them. Links that were queued again in the meantime are left on the list. Returns how many were put back.
+def requeue_failed_items(item_ids=None):
+    requeued = 0
+    with queue_transaction() as database:
+        rows = database.execute("SELECT id FROM queue WHERE status = 'failed'").fetchall()
+        for row in rows:
+            if item_ids and row["id"] not in item_ids:
+                continue
+            cursor = database.execute(
+                "UPDATE OR IGNORE queue SET status = 'queued', attempts = 0, move_attempts = 0, not_before = 0, last_error = NULL, updated_at = ? WHERE id = ?",
+                (time.time(), row["id"]),
+            )
+            if cursor.rowcount:
+                append_journal(database, row["id"], "requeued")
+                requeued += cursor.rowcount
+    return requeued
+
+# Puts items back in the queue whose downloading process is no longer running, and journals
+# them as interrupted. Returns them, with the state and directory they were last journaled with.
+def release_stale_claims():
+    interrupted = []
+    with queue_transaction() as database:
+        rows = database.execute("SELECT id, link, claimed_by FROM queue WHERE status = 'downloading'").fetchall()
+        for row in rows:
+            if is_process_running(row["claimed_by"]):
+                continue
+            last = database.execute(
+                "SELECT state, directory FROM journal WHERE item_id = ? ORDER BY id DESC LIMIT 1", (row["id"],)
+            ).fetchone()
+            state = last["state"] if last else "claimed"
+            directory = last["directory"] if last else None
+            database.execute(
+                "UPDATE queue SET status = 'queued', claimed_by = NULL, updated_at = ? WHERE id = ?",
+                (time.time(), row["id"]),
+            )
+            append_journal(database, row["id"], "interrupted", directory)
+            interrupted.append({"id": row["id"], "link": row["link"], "state": state, "directory": directory})
+    return interrupted
+
+# Adds a row to the session journal inside an open transaction
+def append_journal(database, item_id, state, directory=None):
+    database.execute(
+        "INSERT INTO journal (item_id, state, directory, pid, at) VALUES (?, ?, ?, ?, ?)",
+        (item_id, state, directory, os.getpid(), time.time()),
+    )
+
+# Journals a job's state change: validated, downloading, merging, downloaded or moved. How the
+# item ended (done, removed, failed, retrying) is journaled by finish_queue_item and fail_queue_item.
+# The time each state was first reached is kept on the job for the event log.
+def record_job_state(job, state):
+    job.state_times.setdefault(state, time.monotonic())
+    if job.item_id is None or job.state == state:
+        return
+    job.state = state
+    with queue_transaction() as database:
+        append_journal(database, job.item_id, state, job.directory)
 
-# Save the updated queue to the queue file
-def save_queue():
-    with open(queue_file_path, 'w') as f:
-        for link in queue:
-            f.write(link + "\n")
+# Appends events to the event log, one JSON object per line, and rewrites the metrics file
+def write_events(events):
+    if not events:
+        return
+    with event_log_lock:
+        with open(event_log_file_path, 'a') as f:
+            f.writelines(json.dumps(event) + "\n" for event in events)
+    write_metrics_file()
+
+# Appends one event to the event log, stamped with the time it happened
+def log_event(event, **fields):
+    write_events([{"time": round(time.time(), 3), "event": event, **fields}])
+
+# Starts counting the session's metrics. Only a session writes the metrics file, so a -a run
+# next to it doesn't overwrite the session's numbers with its own.
+def start_session_metrics():
+    global session_metrics
+    session_metrics = {}
+    set_metric("yt_dlp_sc_session_start_time_seconds", round(time.time(), 3))
+    set_metric("yt_dlp_sc_active_downloads", 0)
+    log_event("session_started", pid=os.getpid(), engine=engine)
+
+# Adds to a session metric, labelled with the given labels
+def add_metric(name, value, **labels):
+    if session_metrics is None:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with event_log_lock:
+        session_metrics[key] = session_metrics.get(key, 0) + value
+
+# Sets a session metric, labelled with the given labels
+def set_metric(name, value, **labels):
+    if session_metrics is None:
+        return
+    with event_log_lock:
+        session_metrics[(name, tuple(sorted(labels.items())))] = value
+
+# Writes the session metrics to metrics_file in the Prometheus text format, for node_exporter's
+# textfile collector. The file is replaced in one go, so it is never read half written.
+def write_metrics_file():
+    if not metrics_file or session_metrics is None:
+        return
+    path = os.path.expanduser(metrics_file)
+    lines = []
+    with event_log_lock:
+        for name, (metric_type, description) in metric_definitions.items():
+            samples = sorted((labels, value) for (metric_name, labels), value in session_metrics.items() if metric_name == name)
+            if not samples:
+                continue
+            lines += [f"# HELP {name} {description}", f"# TYPE {name} {metric_type}"]
+            for labels, value in samples:
+                label_text = ",".join(f'{label}="{json.dumps(str(text))[1:-1]}"' for label, text in labels)
+                lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+    try:
+        with open(path + ".tmp", 'w') as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(path + ".tmp", path)
+    except OSError as e:
+        if debug:
+            print(f"{bcolors.ERROR}DEBUG Error 60:{bcolors.ENDC} Could not write metrics to {path}: {e}")
+
+# Records how long one run of a phase took, when the session is profiled
+def record_phase(phase, seconds):
+    if phase_timings is not None:
+        phase_timings.setdefault(phase, []).append(seconds)
+
+# Returns the value below which the given fraction of the sorted values lie, interpolated between
+# the two values nearest to it, so the median of an even count is the mean of the middle two
+def percentile(values, fraction):
+    position = (len(values) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+# Prints how often each phase of the session ran and how long it took: in total, at the median,
+# at the 95th percentile and at most
+def print_profile_report():
+    print(f"\n{bcolors.BOLD}Session profile:{bcolors.ENDC}")
+    print(f"  {'phase':<20} {'count':>6} {'total':>10} {'p50':>9} {'p95':>9} {'max':>9}")
+    for phase in profile_phases:
+        timings = sorted(phase_timings.get(phase, []))
+        if not timings:
+            continue
+        print(f"  {phase:<20} {len(timings):>6} {sum(timings):>9.3f}s {percentile(timings, 0.5):>8.3f}s {percentile(timings, 0.95):>8.3f}s {timings[-1]:>8.3f}s")
+    print(f"")
+
+# Deletes the journal of items that are no longer in the queue, once it is old enough not to matter
+def prune_journal():
+    with queue_transaction() as database:
+        database.execute(
+            "DELETE FROM journal WHERE at < ? AND item_id NOT IN (SELECT id FROM queue WHERE status IN ('queued', 'downloading'))",
+            (time.time() - journal_retention,),
+        )
+
+# Checks whether a process with the given id exists
+def is_process_running(pid):
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+# Returns the key yt-dlp records in its archive for a link, if the link is a single Youtube video
+def link_archive_key(link):
+    parsed = urlparse(link)
+    values = dict(parse_qsl(parsed.query))
+    if parsed.hostname == "www.youtube.com" and parsed.path == "/watch" and "list" not in values and youtube_video_id_pattern.match(values.get("v", "")):
+        return f"youtube {values['v']}"
+    return None
+
+# Returns which of the given keys are in the download archive
+def archived_keys(keys):
+    keys = list(keys)
+    found = set()
+    database = open_queue_database()
+    for start in range(0, len(keys), 500):
+        chunk = keys[start:start + 500]
+        rows = database.execute(f"SELECT key FROM archive WHERE key IN ({', '.join('?' * len(chunk))})", chunk).fetchall()
+        found.update(row["key"] for row in rows)
+    return found
+
+# Checks whether a link is a single video that is already in the download archive
+def is_archived_link(link):
+    key = link_archive_key(link)
+    return key is not None and key in archived_keys([key])
+
+# Adds keys to the download archive in one transaction
+def add_archive_keys(keys):
+    with queue_transaction() as database:
+        database.executemany("INSERT OR IGNORE INTO archive (key) VALUES (?)", ((key,) for key in keys))
+
+# Reads an archive file in yt-dlp's format into the download archive, archive_batch_size lines
+# per transaction. Returns the number of keys read.
+def import_archive_file(path):
+    count = 0
+    batch = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                batch.append(line.strip())
+            if len(batch) >= archive_batch_size:
+                add_archive_keys(batch)
+                count += len(batch)
+                batch = []
+    add_archive_keys(batch)
+    return count + len(batch)
+
+# The download archive as the set yt-dlp's embedded engine takes for download_archive, so it
+# looks up and records ids in the archive table instead of loading a file into memory
+class DownloadArchive:
+    def __contains__(self, key):
+        return key in archived_keys([key])
+
+    def __bool__(self):
+        return True
 
-# Clear the download queue and temporary download folder
+    def add(self, key):
+        add_archive_keys([key])
+
+# Returns the path of the archive file a job's yt-dlp process reads and appends to
+def job_archive_path(job):
+    return os.path.join(archive_directory, f"job-{job.item_id}.txt")
+
+# Writes the archive file for a job's yt-dlp process, holding only the part of the archive it
+# needs: the archived entries of the playlist or channel it downloads. Ones that were not
+# prefetched are listed flat first, a channel's own page by its videos tab as expand_playlists
+# does, and the listing is cached for the download to load. Single videos are checked before the
+# process is started. Returns None, with the reason added to the job's errors, if the entries
+# can't be listed, as the process would download archived videos again.
+def write_job_archive(job):
+    os.makedirs(archive_directory, exist_ok=True)
+    path = job_archive_path(job)
+    keys = []
+    if not link_archive_key(job.link):
+        url = listing_url(job.link)
+        info = playlist_info(url)
+        if info is None:
+            job.errors.append(f"ERROR: Could not list {url} to check its videos against the download archive")
+            return None
+        # The download loads the listing that was checked, so a channel's page gets its videos tab
+        if url != job.link or cached_info_path(job.link) is None:
+            save_cached_info(job.link, info)
+        entries = info.get("entries") or [] if info.get("_type") == "playlist" else [info]
+        keys = [f"{(entry.get('extractor_key') or entry.get('ie_key')).lower()} {entry['id']}" for entry in entries
+                if entry and entry.get("id") and (entry.get("extractor_key") or entry.get("ie_key"))]
+    with open(path, 'w', encoding='utf-8') as f:
+        f.writelines(f"{key}\n" for key in archived_keys(keys))
+    return path
+
+# Adds what a job's yt-dlp process recorded in its archive file to the download archive
+def import_job_archive(path):
+    if os.path.exists(path):
+        import_archive_file(path)
+        os.remove(path)
+
+# Imports the job archive files a killed session left behind. The files of downloads another
+# session is still running are left to it.
+def import_job_archives():
+    if os.path.isdir(archive_directory):
+        claimed = {f"job-{item_id}.txt" for item_id in live_claimed_item_ids()}
+        for filename in os.listdir(archive_directory):
+            if filename.startswith("job-") and filename not in claimed:
+                import_job_archive(os.path.join(archive_directory, filename))
+
+# Returns the ids of the items being downloaded by a process that is still running
+def live_claimed_item_ids():
+    rows = open_queue_database().execute("SELECT id, claimed_by FROM queue WHERE status = 'downloading'").fetchall()
+    return {row["id"] for row in rows if is_process_running(row["claimed_by"])}
+
+# Clear the download queue and temporary download folder. Refused while the daemon or another
+# session is downloading, as their yt-dlp processes are writing into the workspaces.
 def clear_queue():
     yt_dlp_folder = os.path.expanduser(temp_download_directory)
     archive_file = os.path.join(yt_dlp_folder, 'downloaded_videos.txt')
 
-    # Clear the queue file
-    open(queue_file_path, 'w').close()
+    if send_daemon_command({"command": "status"}) is not None:
+        print(f"{bcolors.ERROR}Error:{bcolors.ENDC} A daemon is running and downloads the queue. Stop it before clearing the queue.")
+        return
+    # Clear the queue, unless a session claimed one of its links. Checked in the same transaction,
+    # so no link can be claimed in between.
+    with queue_transaction() as database:
+        rows = database.execute("SELECT claimed_by FROM queue WHERE status = 'downloading'").fetchall()
+        busy = sum(1 for row in rows if is_process_running(row["claimed_by"]))
+        if not busy:
+            database.execute("DELETE FROM queue")
+            database.execute("DELETE FROM journal")
+    if busy:
+        print(f"{bcolors.ERROR}Error:{bcolors.ENDC} {busy} links are being downloaded by another session. Clear the queue once it has finished.")
+        return
+    # Keep what its downloads recorded in the download archive
+    import_job_archives()
     if not suppress_output:
         print(f"Download queue cleared.")
+    # Links queued and claimed since then have workspaces in use
+    claimed = {f"job-{item_id}" for item_id in live_claimed_item_ids()}
 
-    # Remove temp download folder
+    # Remove temp download folder, one workspace at a time
     if os.path.exists(yt_dlp_folder):
-        for root, dirs, files in os.walk(yt_dlp_folder, topdown=False):
-            for name in files:
-                file_path = os.path.join(root, name)
-                print(f"Deleting file: {file_path}")
-                os.remove(file_path)
-            for name in dirs:
-                dir_path = os.path.join(root, name)
-                print(f"Deleting temporary download folder")
-                shutil.rmtree(dir_path)
+        file_count = 0
+        byte_count = 0
+        for entry in os.scandir(yt_dlp_folder):
+            if entry.name in claimed:
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                for root, dirs, files in os.walk(entry.path):
+                    file_count += len(files)
+                    byte_count += sum(os.lstat(os.path.join(root, name)).st_size for name in files)
+                shutil.rmtree(entry.path)
+            else:
+                file_count += 1
+                byte_count += entry.stat(follow_symlinks=False).st_size
+                os.remove(entry.path)
+        print(f"Deleted {file_count} files ({format_bytes(byte_count)}) from the temporary download folder.")
         if not suppress_output:
             print(f"All contents in {yt_dlp_folder} cleared.")
     else:
@@ -365,21 +1158,52 @@ def show_help():
     help_text = r"""  Commands:
 
     - show          : Show the current download queue and settings.
+    - prefetch      : Resolve and cache the info of every queued link.
     - start         : Start the download session.
+                      start -j/--jobs <number> runs that many downloads at once.
+                      start --resume continues interrupted downloads first.
+                      start --profile [file] times each phase, and writes a cProfile dump to file.
+    - daemon        : Run in the background, downloading links as soon as they are queued.
+                      Takes the same options as start. While it runs, -a, -A and -r go to it.
+    - status        : Show what the daemon is downloading.
+    - pause         : Let the daemon's running downloads finish, but start no new ones.
+    - resume        : Let a paused daemon start downloads again.
+    - stop          : Stop the daemon once its running downloads finish.
+    - failed        : Show the downloads that failed for good, and why.
+    - requeue       : Put every failed download back in the queue.
+                      requeue <id>... puts back only those.
+    - subscribe     : Subscribe to a channel or playlist, whose new videos sync queues.
+                      subscribe <url> --new-only skips the videos it has already.
+                      Takes --priority like --add.
+    - subscriptions : Show the subscriptions.
+    - unsubscribe   : Remove a subscription by id.
+    - sync          : Queue the new videos of every subscription.
+                      sync <id>... syncs only those.
     - clear         : Clear the download queue manually.
 
     -a, --add
-                    Add a link to the download queue.
+                    Add one or more links to the download queue. Use - to read links from stdin.
+                    --priority <low|normal|high> downloads them before or after the other links.
+
+    -A, --add-file
+                    Add every link in one or more files to the download queue.
+                    Takes --priority like --add.
 
     -r, --remove
                     Remove a link from the queue by index.
 
+    --import-archive
+                    Import a yt-dlp download archive file into the download archive.
+
     -d, --setdir
                     Set the download directory.
 
     -o, --options
                     Set yt-dlp options.
 
+    -e, --engine
+                    Sets the download engine, subprocess or embedded.
+
     -t, --temp
                     Enables or disables the temporary download folder option.
 
@@ -408,116 +1232,610 @@ def show_help():
 def print_version():
     print(f"yt-dlp-sc version: {yt_dlp_sc_version}")
 
-# Adds input link to the queue
-def add_to_queue(link):
-    global queue
-    queue.append(link)
-    save_queue()
-    print(f"Added to queue: {link}")
+# Reads links from a file or stdin, one per line, skipping blank lines and # comments
+def read_links(f):
+    return [line.strip() for line in f if line.strip() and not line.lstrip().startswith("#")]
+
+# Adds input links to the queue in one go, and returns the lines saying what happened. The queue
+# is listed afterwards when show_queue is set, which by default it is only for a single link.
+# Links already queued at a lower priority move up to the given one.
+def queue_links(links, show_queue=None, priority=0):
+    if show_queue is None:
+        show_queue = len(links) == 1
+    output = []
+
+    # Videos already downloaded are not queued again
+    links = [normalize_link(link) for link in links]
+    archived = archived_keys(filter(None, map(link_archive_key, links)))
+    if archived:
+        links = [link for link in links if link_archive_key(link) not in archived]
+        output.append(f"Skipped {len(archived)} already downloaded links.")
+        if not links:
+            return output
+    added = enqueue_links(links, priority)
+    if len(links) == 1:
+        if added:
+            output.append(f"Added to queue: {links[0]}")
+        else:
+            output.append(f"Already in queue: {links[0]}")
+    else:
+        output.append(f"Added {added} links to the queue, skipped {len(links) - added} duplicates.")
+    if not show_queue:
+        return output
+    load_queue()
 
     if not queue:
-        print(f"Current download queue is empty.")
-        return
-    print(f"Current download queue:")
+        output.append(f"Current download queue is empty.")
+        return output
+    output.append(f"Current download queue:")
     for index, link in enumerate(queue):
-        print(f"{index}: {link}")
+        output.append(f"{index}: {link}")
+    return output
+
+# Adds input links to the queue, printing the outcome
+def add_to_queue(links, show_queue=None, priority=0):
+    print("\n".join(queue_links(links, show_queue, priority)))
+
+# Removes the link at input index from the queue, and returns the line saying what happened.
+# A link being downloaded is left alone, as the session that claimed it still records its outcome.
+def remove_queue_link(index):
+    if index < 0:
+        return f"Index out of range."
+    with queue_transaction() as database:
+        row = database.execute(
+            f"SELECT id, link, status FROM queue WHERE status IN ('queued', 'downloading') ORDER BY {queue_schedule_order} LIMIT 1 OFFSET ?",
+            (index,),
+        ).fetchone()
+        if row is not None and row["status"] == "queued":
+            database.execute("DELETE FROM queue WHERE id = ? AND status = 'queued'", (row["id"],))
+    if row is None:
+        return f"Index out of range."
+    if row["status"] != "queued":
+        return f"{bcolors.ERROR}Error:{bcolors.ENDC} {row['link']} is being downloaded and can't be removed until it finishes."
+    return f"Removed from queue: {row['link']}"
 
 # Removes link at input index from queue
 def remove_from_queue(index):
-    if 0 <= index < len(queue):
-        removed = queue.pop(index)
-        save_queue()
-        print(f"Removed from queue: {removed}")
-    else:
-        print(f"Index out of range.")
+    print(remove_queue_link(index))
+
+# Returns the shared HTTP session, creating it on first use so checks reuse pooled connections.
+# requests is imported here, as only URL checks use it.
+def get_http_session():
+    global http_session
+    global requests
+    if http_session is None:
+        requests = importlib.import_module("requests")
+        http_session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=max(preflight_jobs, 1))
+        http_session.mount("https://", adapter)
+        http_session.mount("http://", adapter)
+        http_session.headers["User-Agent"] = f"yt-dlp-sc/{yt_dlp_sc_version}"
+    return http_session
+
+# Loads the URL check cache from disk into memory, dropping entries older than ping_cache_ttl.
+# The cache is only published once it is complete, so a check running next to this doesn't see
+# it half loaded.
+def load_ping_cache():
+    global ping_cache
+    loaded = {}
+    try:
+        with open(ping_cache_file_path, 'r') as f:
+            cached = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        cached = {}
+    now = time.time()
+    for url, entry in cached.items():
+        if now - entry.get("checked", 0) < ping_cache_ttl:
+            loaded[url] = entry
+    ping_cache = loaded
+    return ping_cache
+
+# Loads the URL check cache unless it already is. Checks run from a thread pool, so only the
+# first of them reads the file and the others wait for it instead of loading over its entries.
+def ensure_ping_cache():
+    if ping_cache is not None:
+        return
+    with ping_cache_lock:
+        if ping_cache is None:
+            load_ping_cache()
+
+# Saves the in-memory URL check cache to disk
+def save_ping_cache():
+    if ping_cache is None:
+        return
+    with ping_cache_lock:
+        with open(ping_cache_file_path, 'w') as f:
+            json.dump(ping_cache, f)
+
+# Pings a URL. Returns None if it answers, else why it doesn't. Only answers are cached, for
+# ping_cache_ttl seconds, so a link that failed once is checked again the next time.
+def ping_error(url):
+    ensure_ping_cache()
+    started = time.monotonic()
+    cached = ping_cache.get(url)
+    if cached and cached["ok"] and time.time() - cached["checked"] < ping_cache_ttl:
+        record_phase("url check (cached)", time.monotonic() - started)
+        return None
+
+    error = probe_url(url)
+    seconds = time.monotonic() - started
+    record_phase("url check", seconds)
+    add_metric("yt_dlp_sc_probes_total", 1, result="ok" if error is None else "failed")
+    add_metric("yt_dlp_sc_probe_seconds_total", seconds)
+    log_event("probed", link=url, ok=error is None, seconds=round(seconds, 3))
+    with ping_cache_lock:
+        if error is None:
+            ping_cache[url] = {"ok": True, "checked": time.time()}
+        else:
+            ping_cache.pop(url, None)
+    return error
 
-# Ping a URL, and remove from queue if no answer
-def check_ping(url):
+# Sends a HEAD request to a URL, falling back to a one byte ranged GET if HEAD is refused.
+# Returns None if the URL answers, else why it doesn't.
+def probe_url(url):
+    session = get_http_session()
     try:
-        response = requests.get(url, timeout=5)
-        if response.status_code == 200:
-            return True
-        elif response.status_code != 200:
-            raise Exception(f"{bcolors.ERROR}Error:{bcolors.ENDC} {response.status_code}")
+        response = session.head(url, timeout=5, allow_redirects=True)
+        if response.status_code in (405, 501):
+            response = session.get(url, timeout=5, headers={"Range": "bytes=0-0"}, stream=True)
+            response.close()
+        if response.status_code in (200, 206):
+            return None
+        print(f"Error with {url}: {bcolors.ERROR}Error:{bcolors.ENDC} {response.status_code}.")
+        return f"HTTP Error {response.status_code}"
     except (requests.ConnectionError, requests.Timeout) as e:
         print(f"URL {url} is not responding.")
-        return False
+        return "URL is not responding"
     except Exception as e:
         print(f"Error with {url}: {e}.")
-        return False
+        return str(e)
+
+# Returns whether a failed URL check means the link is gone for good, and can be removed from the
+# queue: the page doesn't exist (HTTP 404 or 410). Other failures may pass, and are retried.
+def url_is_gone(error):
+    return error in ("HTTP Error 404", "HTTP Error 410")
+
+# Checks every Youtube link in the queue at once before downloading starts, so each
+# URL is probed a single time. Returns the number of links that did not respond.
+def validate_queue(links):
+    links = [link for link in dict.fromkeys(links) if "www.youtube.com/" in link]
+    if not links:
+        return 0
+    print(f"{bcolors.OKSTATUS}Checking responsiveness of {len(links)} queued URLs{bcolors.ENDC}")
+    started = time.monotonic()
+    ensure_ping_cache()
+    with ThreadPoolExecutor(max_workers=max(preflight_jobs, 1)) as pool:
+        results = list(pool.map(ping_error, links))
+    record_phase("queue check", time.monotonic() - started)
+    save_ping_cache()
+    unresponsive = len(results) - results.count(None)
+    if unresponsive:
+        print(f"{bcolors.ERROR}{unresponsive} of {len(links)} URLs are not responding.{bcolors.ENDC}\n")
+    else:
+        print(f"{bcolors.COMPLETED}All queued URLs are responsive.{bcolors.ENDC}\n")
+    return unresponsive
 
 def contains_substring(main_string, substring):
 
     return substring in main_string
 
-item_number = "?"
-total_items = "?"
-
-def extract_download_details(line):
-    global item_number
-    global total_items
-    # Extract the fragment number, total fragments, ETA, download speed, total size, and playlist progress.
-    fragment_match = re.search(r"\(frag (\d+)/(\d+)\)", line)
-    eta_match = re.search(r"ETA (\d{2}:\d{2})", line)
-    speed_match = re.search(r"at\s+([~\d.]+[A-Za-z]+/s)", line)
-    size_match = re.search(r"of ~\s+([~\d.]+[A-Za-z]+)", line)
-    download_count = re.search(r"Downloading item (\d+) of (\d+)", line)
-
-    # Extract fragments, ETA, download speed, and total size if available
-    current_fragment = fragment_match.group(1) if fragment_match else "?"
-    total_fragment = fragment_match.group(2) if fragment_match else "?"
-    eta = eta_match.group(1) if eta_match else "N/A"
-    speed = speed_match.group(1) if speed_match else "N/A"
-    total_size = size_match.group(1) if size_match else "N/A"
-    pulled_item_number = download_count.group(1) if download_count else "?"
-    pulled_total_items = download_count.group(2) if download_count else "?"
-
-    if str.isdigit(pulled_item_number):
-        item_number = pulled_item_number
-    if str.isdigit(pulled_total_items):
-        total_items = pulled_total_items
-
-    return current_fragment, total_fragment, eta, speed, total_size, item_number, total_items
-
-def format_video_download_status(line):
-    current_fragment, total_fragment, eta, speed, total_size, item_number, total_items = extract_download_details(line)
-
-    if str.isdigit(f"{item_number}") and str.isdigit(f"{total_items}"):
-        formatted_line = f"Downloading Video fragment {current_fragment}/{total_fragment} | ETA: {eta} at ~ {speed} | Video {item_number} of {total_items} size ~ {total_size}"
-        return formatted_line
-    else:
-        formatted_line = f"Downloading Video fragment {current_fragment}/{total_fragment} | ETA: {eta} at ~ {speed} | Video size ~ {total_size}"
-        return formatted_line
-
-def format_audio_download_status(line):
-    current_fragment, total_fragment, eta, speed, total_size, item_number, total_items = extract_download_details(line)
-
-    if str.isdigit(f"{item_number}") and str.isdigit(f"{total_items}"):
-        formatted_line = f"Downloading Audio | ETA: {eta} at ~ {speed} | Audio {item_number} of {total_items} size ~ {total_size}"
-        return formatted_line
-    else:
-        formatted_line = f"Downloading Audio | ETA: {eta} at ~ {speed} | Video size ~ {total_size}"
-        return formatted_line
-
-def format_merging_status(line):
-    # Extract the relevant information from the line
-    current_fragment, total_fragment, eta, speed, total_size, item_number, total_items = extract_download_details(line)
-
-    if str.isdigit(f"{item_number}") and str.isdigit(f"{total_items}"):
-        formatted_line = f"Merging Video and Audio files for video {item_number} of {total_items}."
-        return formatted_line
+# One parsed line of yt-dlp output. kind is "video", "audio", "item" or "merge".
+class ProgressRecord:
+    __slots__ = ("kind", "percent", "total_size", "speed", "eta", "fragment", "total_fragments", "item_number", "total_items")
+
+    def __init__(self, kind, percent=None, total_size=None, speed=None, eta=None, fragment=None, total_fragments=None, item_number=None, total_items=None):
+        self.kind = kind
+        self.percent = percent
+        self.total_size = total_size
+        self.speed = speed
+        self.eta = eta
+        self.fragment = fragment
+        self.total_fragments = total_fragments
+        self.item_number = item_number
+        self.total_items = total_items
+
+# Classifies and parses one line of yt-dlp output in a single pass. Returns None for lines
+# that carry no progress information.
+def parse_progress_line(line):
+    line = line.lstrip()
+    if line.startswith("[download]"):
+        match = progress_line_pattern.match(line)
+        if match and match.group("eta"):
+            percent, total_size, speed, eta, fragment, total_fragments = match.groups()
+            return ProgressRecord("video" if fragment else "audio", percent, total_size, speed, eta, fragment, total_fragments)
+        match = download_item_pattern.search(line)
+        if match:
+            return ProgressRecord("item", item_number=match.group(1), total_items=match.group(2))
+    elif line.startswith("[Merger]") and "Merging" in line:
+        return ProgressRecord("merge")
+    return None
+
+# Formats a parsed record into the status line shown for a job
+def format_progress_status(record, job):
+    eta = record.eta or "N/A"
+    speed = record.speed or "N/A"
+    total_size = record.total_size or "N/A"
+    has_count = job.item_number.isdigit() and job.total_items.isdigit()
+
+    if record.kind == "video":
+        if has_count:
+            return f"Downloading Video fragment {record.fragment or '?'}/{record.total_fragments or '?'} | ETA: {eta} at ~ {speed} | Video {job.item_number} of {job.total_items} size ~ {total_size}"
+        return f"Downloading Video fragment {record.fragment or '?'}/{record.total_fragments or '?'} | ETA: {eta} at ~ {speed} | Video size ~ {total_size}"
+    elif record.kind == "audio":
+        if has_count:
+            return f"Downloading Audio | ETA: {eta} at ~ {speed} | Audio {job.item_number} of {job.total_items} size ~ {total_size}"
+        return f"Downloading Audio | ETA: {eta} at ~ {speed} | Video size ~ {total_size}"
+    elif record.kind == "item":
+        return f"Starting video {job.item_number} of {job.total_items}"
+    elif record.kind == "merge":
+        if has_count:
+            return f"Merging Video and Audio files for video {job.item_number} of {job.total_items}."
+        return f"Merging Video and Audio files"
+
+# Returns the path of a link's cached info file, or None if there is no fresh one
+def cached_info_path(link):
+    info_path = os.path.join(info_cache_directory, hashlib.sha1(link.encode()).hexdigest()[:20] + ".info.json")
+    try:
+        if time.time() - os.path.getmtime(info_path) < info_cache_ttl:
+            return info_path
+    except OSError:
+        pass
+    return None
+
+# Writes a link's info dict to the cache, replacing the old file in one step
+def save_cached_info(link, info):
+    os.makedirs(info_cache_directory, exist_ok=True)
+    info_path = os.path.join(info_cache_directory, hashlib.sha1(link.encode()).hexdigest()[:20] + ".info.json")
+    with open(info_path + ".tmp", 'w') as f:
+        json.dump(info, f)
+    os.replace(info_path + ".tmp", info_path)
+
+# Asks yt-dlp for a URL's info dict without downloading it. Playlists are listed flat.
+def extract_info_json(url):
+    command = ["yt-dlp"] + yt_dlp_options.split() + ["--dump-single-json", "--flat-playlist", "--no-warnings", url]
+    started = time.monotonic()
+    result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    seconds = time.monotonic() - started
+    record_phase("prefetch", seconds)
+    add_metric("yt_dlp_sc_extractions_total", 1, result="ok" if result.returncode == 0 else "failed")
+    add_metric("yt_dlp_sc_extraction_seconds_total", seconds)
+    log_event("extracted", link=url, exit_code=result.returncode, seconds=round(seconds, 3))
+    if result.returncode != 0:
+        if debug:
+            print(f"{bcolors.ERROR}DEBUG Error 50:{bcolors.ENDC} Could not extract {url}: {result.stderr.strip()}")
+        return None
+    try:
+        return json.loads(result.stdout)
+    except json.JSONDecodeError:
+        return None
+
+# Returns True for links yt-dlp downloads as a playlist, which Youtube channels and their tabs are too
+def is_playlist_link(link):
+    parsed = urlparse(link)
+    return parsed.hostname in youtube_hosts and (
+        "list" in dict(parse_qsl(parsed.query)) or bool(youtube_channel_tab_pattern.match(parsed.path.rstrip("/"))))
+
+# Returns a playlist's flat info, from the cache when prefetch has listed it already
+def playlist_info(link):
+    info_path = cached_info_path(link)
+    if info_path is not None:
+        try:
+            with open(info_path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            pass
+    return extract_info_json(link)
+
+# Replaces the queued playlist and channel links, or only the ones with the given ids, by a queue
+# item for each of their videos, so the videos are spread over the workers and take turns with
+# other playlists instead of going through one long yt-dlp call. The videos keep the playlist's
+# priority, and the playlist or channel as their source. A channel's own page is listed by its
+# videos tab, like a subscription. Links that can't be listed stay in the queue, and are listed
+# again when their turn comes, failing like a download if they still can't be.
+def expand_playlists(item_ids=None):
+    rows = open_queue_database().execute(
+        "SELECT id, link, priority FROM queue WHERE status = 'queued' AND (link LIKE '%list=%' OR link NOT LIKE 'https://www.youtube.com/watch?%')"
+    ).fetchall()
+    playlists = [row for row in rows if is_playlist_link(row["link"]) and (item_ids is None or row["id"] in item_ids)]
+    if not playlists:
+        return 0
+    print(f"{bcolors.OKSTATUS}Listing {len(playlists)} playlists and channels{bcolors.ENDC}")
+    with ThreadPoolExecutor(max_workers=max(prefetch_jobs, 1)) as pool:
+        infos = list(pool.map(playlist_info, [listing_url(row["link"]) for row in playlists]))
+
+    expanded = 0
+    for row, info in zip(playlists, infos):
+        if info is None or info.get("_type") != "playlist":
+            print(f"{bcolors.ERROR}Could not list playlist or channel, it is listed again when its turn comes:{bcolors.ENDC} {row['link']}")
+            continue
+        # A channel's videos share a source with the ones of it queued on their own
+        if "list=" not in row["link"] and info.get("channel_id"):
+            source = f"channel {info['channel_id']}"
+        else:
+            source = f"playlist {info.get('id') or row['link']}"
+        durations = {}
+        for entry in info.get("entries") or []:
+            url = entry and (entry.get("webpage_url") or entry.get("url"))
+            if url:
+                durations[normalize_link(url)] = entry.get("duration")
+        links = list(durations)
+        # Videos already downloaded are not queued again
+        archived = archived_keys(filter(None, map(link_archive_key, links)))
+        links = [link for link in links if link_archive_key(link) not in archived]
+        added = enqueue_links(links, row["priority"], source, durations)
+        finish_queue_item(row["id"], "expanded")
+        expanded += 1
+        print(f"{bcolors.COMPLETED}Queued {added} videos of:{bcolors.ENDC} {row['link']}")
+    return expanded
+
+# Stores the channel and duration of prefetched videos, so the scheduler can share turns
+# between channels and start short videos first
+def record_link_details(infos):
+    details = {}
+    for link, info in infos.items():
+        if info is None or info.get("_type") == "playlist":
+            continue
+        channel = info.get("channel_id") or info.get("uploader_id")
+        details[link_hash(link)] = (info.get("duration"), f"channel {channel}" if channel else None)
+    with queue_transaction() as database:
+        rows = database.execute(
+            "SELECT id, link_hash, priority, source, lane_round FROM queue WHERE status = 'queued' ORDER BY id"
+        ).fetchall()
+        for row in rows:
+            if row["link_hash"] not in details:
+                continue
+            duration, source = details[row["link_hash"]]
+            lane_round = row["lane_round"]
+            # A newly learned source moves the item to that source's next free turn
+            if row["source"] is None and source is not None:
+                lane_round = next_lane_round(database, row["priority"], source)
+            database.execute(
+                "UPDATE queue SET duration = COALESCE(?, duration), source = COALESCE(source, ?), lane_round = ? WHERE id = ?",
+                (duration, source, lane_round, row["id"]),
+            )
+
+# Resolves the info of every queued link, prefetch_jobs at a time, and caches it so start can
+# skip extraction. Playlists are expanded into their videos first, and those are resolved with
+# the rest.
+def prefetch_queue():
+    load_session_modules()
+    if expand_playlists():
+        load_queue()
+    # Videos already in the download archive are taken out of the queue instead of extracted
+    archived = archived_keys(filter(None, map(link_archive_key, queue)))
+    if archived:
+        with queue_transaction() as database:
+            for link in queue:
+                if link_archive_key(link) in archived:
+                    database.execute(
+                        "UPDATE queue SET status = 'done', updated_at = ? WHERE link = ? AND status = 'queued'",
+                        (time.time(), link),
+                    )
+        print(f"{bcolors.OKSTATUS}Dropped {len(archived)} already downloaded links from the queue.{bcolors.ENDC}")
+        load_queue()
+
+    links = [link for link in dict.fromkeys(queue) if cached_info_path(link) is None]
+    cached_count = len(set(queue)) - len(links)
+    if not links:
+        print(f"All {cached_count} queued links are already cached.")
+        return
+    print(f"{bcolors.OKSTATUS}Prefetching {len(links)} links,{bcolors.ENDC} {cached_count} already cached.")
+
+    with ThreadPoolExecutor(max_workers=max(prefetch_jobs, 1)) as pool:
+        infos = dict(zip(links, pool.map(extract_info_json, links)))
+
+    for link, info in infos.items():
+        if info is None:
+            print(f"{bcolors.ERROR}Could not prefetch:{bcolors.ENDC} {link}")
+            continue
+        save_cached_info(link, info)
+        print(f"{bcolors.COMPLETED}Cached:{bcolors.ENDC} {link}")
+    record_link_details(infos)
+
+# Parses a rate like 80M or 500K into bytes per second, with the binary units yt-dlp's -r uses.
+# Returns None if it is not a rate.
+def parse_rate(text):
+    match = rate_pattern.match(text)
+    if not match:
+        return None
+    unit = match.group(2).upper()
+    return int(float(match.group(1)) * 1024 ** ("KMGT".index(unit) + 1 if unit else 0))
+
+# Parses rate_schedule, e.g. "09:00-17:00=10M, 17:00-09:00=0", into (start, end, rate) windows
+# in minutes of the day. A rate of 0 means unlimited. Windows that can't be parsed are reported and skipped.
+def parse_rate_schedule(schedule):
+    windows = []
+    for window in schedule.split(","):
+        if not window.strip():
+            continue
+        match = rate_window_pattern.match(window)
+        rate = parse_rate(match.group(5)) if match else None
+        if rate is None:
+            print(f"{bcolors.ERROR}Error:{bcolors.ENDC} Ignoring rate_schedule entry {window.strip()}, expected HH:MM-HH:MM=<rate>")
+            continue
+        start = int(match.group(1)) * 60 + int(match.group(2))
+        end = int(match.group(3)) * 60 + int(match.group(4))
+        windows.append((start, end, rate))
+    return windows
+
+# Shares one download rate between every running download of a session, from rate_schedule for
+# the time of day or else rate_limit. Embedded downloads draw from a token bucket in their progress
+# hooks, so the rate is shared out as downloads start and finish and follows the schedule as it
+# changes. A yt-dlp process can't be slowed once it runs, so it gets an -r share of the downloads
+# running when it starts, and is restarted with a new one when that share changes.
+class BandwidthGovernor:
+    def __init__(self):
+        self.running = set()
+        self.schedule = parse_rate_schedule(rate_schedule)
+        self.default_rate = parse_rate(rate_limit) or 0
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    # Returns the session's rate in bytes per second right now, or None if it is unlimited
+    def budget(self):
+        now = time.localtime()
+        minute = now.tm_hour * 60 + now.tm_min
+        for start, end, rate in self.schedule:
+            if start <= minute < end or (end < start and (minute >= start or minute < end)):
+                return rate or None
+        return self.default_rate or None
+
+    # Returns whether the session has a limit at any time of day
+    def limited(self):
+        return bool(self.default_rate or self.schedule)
+
+    # Counts a job as downloading, or no longer downloading, for sharing out the rate
+    def add_download(self, job):
+        with self.lock:
+            self.running.add(job)
+
+    def remove_download(self, job):
+        with self.lock:
+            self.running.discard(job)
+
+    # Returns the -r value for a job's yt-dlp process, or None if it is unlimited. The rate is split
+    # between the downloads running now, the job's own included, and since yt-dlp applies -r to
+    # each fragment thread, between those as well.
+    def process_rate(self, job, threads):
+        budget = self.budget()
+        if budget is None:
+            return None
+        with self.lock:
+            downloads = len(self.running | {job})
+        return max(budget // (downloads * max(threads, 1)), 1024)
+
+    # Takes the bytes a download just received out of the bucket, and holds the download's thread
+    # until the bucket has refilled enough to cover them
+    def consume(self, byte_count):
+        budget = self.budget()
+        if budget is None or byte_count <= 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            # At most one second of budget is saved up, so an idle moment can't turn into a burst
+            self.tokens = min(budget, self.tokens + (now - self.updated) * budget)
+            self.updated = now
+            self.tokens -= byte_count
+            delay = -self.tokens / budget
+        if delay > 0:
+            time.sleep(delay)
+
+# Returns the -N set in yt_dlp_options, or 1 if it sets none
+def configured_concurrent_fragments():
+    match = concurrent_fragments_pattern.search(yt_dlp_options)
+    return max(int(match.group(1)), 1) if match else 1
+
+# Loads the throughput measured for each -N per host, dropping measurements older than fragment_tuning_ttl
+def load_fragment_tuning():
+    global fragment_tuning
+    fragment_tuning = {}
+    try:
+        with open(fragment_tuning_file_path, 'r') as f:
+            cached = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return fragment_tuning
+    now = time.time()
+    for host, measurements in cached.items():
+        fresh = {threads: measurement for threads, measurement in measurements.items() if now - measurement.get("measured", 0) < fragment_tuning_ttl}
+        if fresh:
+            fragment_tuning[host] = fresh
+    return fragment_tuning
+
+# Picks the -N a host's next download uses by hill climbing over its measured throughput. While the
+# best -N so far is also the highest tried, it is doubled. Once a higher one was slower, the
+# untried neighbours of the best are tried, and after that the best is kept until it expires.
+def tuned_concurrent_fragments(host):
+    if fragment_tuning is None:
+        load_fragment_tuning()
+    with fragment_tuning_lock:
+        measured = {int(threads): measurement["speed"] for threads, measurement in fragment_tuning.get(host, {}).items()}
+    if not measured:
+        return min(configured_concurrent_fragments(), max_concurrent_fragments)
+    best = max(measured, key=measured.get)
+    candidates = [best + 1, best - 1]
+    if best == max(measured):
+        candidates.insert(0, min(best * 2, max_concurrent_fragments))
+    for candidate in candidates:
+        if 1 <= candidate <= max_concurrent_fragments and candidate not in measured:
+            return candidate
+    return best
+
+# Parses a speed from yt-dlp's progress output, e.g. ~1.50MiB/s, into bytes per second
+def parse_speed(speed):
+    return parse_rate(speed.lstrip("~").removesuffix("/s"))
+
+# Stores the throughput a finished download got with its -N. A repeated -N is averaged with its
+# last measurement, so one slow download doesn't rule it out for good.
+def record_fragment_throughput(job):
+    if job.concurrent_fragments is None or len(job.speed_samples) < fragment_tuning_min_samples:
+        return
+    if fragment_tuning is None:
+        load_fragment_tuning()
+    # The first samples are taken while the fragment threads ramp up, so they are left out
+    samples = job.speed_samples[len(job.speed_samples) // 5:]
+    speed = sum(samples) / len(samples)
+    with fragment_tuning_lock:
+        measurements = fragment_tuning.setdefault(job.host, {})
+        previous = measurements.get(str(job.concurrent_fragments))
+        if previous:
+            speed = (previous["speed"] + speed) / 2
+        measurements[str(job.concurrent_fragments)] = {"speed": speed, "measured": time.time()}
+        with open(fragment_tuning_file_path, 'w') as f:
+            json.dump(fragment_tuning, f)
+
+# Builds the yt-dlp command for a job. Links with fresh cached info are loaded from it. Resumed
+# links get --continue after the user's options, so their partial files are picked up, and the
+# bandwidth governor's share goes last so it wins over a -r in the options. With tune_fragments
+# the -N in the options is replaced by the one tuned for the link's host. Returns None if the
+# job's archive file can't be written.
+def build_download_command(job):
+    archive_path = write_job_archive(job)
+    if archive_path is None:
+        return None
+    info_path = cached_info_path(job.link)
+    source = ["--load-info-json", info_path] if info_path else [job.link]
+    # A download restarted for a new rate keeps the -N it was tuned to
+    if tune_fragments:
+        job.concurrent_fragments = job.concurrent_fragments or tuned_concurrent_fragments(job.host)
+        options = concurrent_fragments_pattern.sub(" ", yt_dlp_options).split() + ["-N", str(job.concurrent_fragments)]
     else:
-        formatted_line = f"Merging Video and Audio files"
-        return formatted_line
-
-# Starts the downloading of each link in queue, sequentially.
-def download_queue():
-    global download_archive
-    global download_directory
-    global temp_download_directory
-    global suppress_output
-    global queue
-
+        options = yt_dlp_options.split()
+    options += ["--continue"] if job.resume else []
+    job.rate = bandwidth_governor.process_rate(job, job.concurrent_fragments or configured_concurrent_fragments()) if bandwidth_governor else None
+    if job.rate:
+        options += ["-r", str(job.rate)]
+    command = ["yt-dlp", "--download-archive", archive_path] + options + source
+    if debug:
+        print(f"{bcolors.OKSTATUS}Command (pretty):{bcolors.ENDC} {' '.join(command)}\n")
+        print(f"{bcolors.OKSTATUS}Command (raw):{bcolors.ENDC} {command}\n")
+    return command
+
+# Imports what downloading and prefetching use: asyncio and subprocess to run yt-dlp, thread
+# pools for checks, prefetches and moves, and rich to draw progress
+def load_session_modules():
+    global asyncio
+    global subprocess
+    global Live
+    global Panel
+    global Table
+    global ThreadPoolExecutor
+    global wait
+    global FIRST_COMPLETED
+    if asyncio is not None:
+        return
+    asyncio = importlib.import_module("asyncio")
+    subprocess = importlib.import_module("subprocess")
+    futures = importlib.import_module("concurrent.futures")
+    ThreadPoolExecutor = futures.ThreadPoolExecutor
+    wait = futures.wait
+    FIRST_COMPLETED = futures.FIRST_COMPLETED
+    Live = importlib.import_module("rich.live").Live
+    Panel = importlib.import_module("rich.panel").Panel
+    Table = importlib.import_module("rich.table").Table
+
+# Prints the session settings and returns the directory yt-dlp should download into
+def print_session_header():
     # CLears the terminal
     print(f"\033c")
 
@@ -540,29 +1858,737 @@ def download_queue():
         print(f"Temporary folder is {bcolors.OKRED}disabled{bcolors.ENDC}.")
         print(f"{bcolors.OKSTATUS}Downloading directly to final directory:{bcolors.ENDC} {os.path.expanduser(current_download_directory)}\n")
 
-    while queue:
-        # Get the first link from the queue
-        link = queue[0]
+    if tune_fragments:
+        print(f"Concurrent fragments are {bcolors.COMPLETED}tuned{bcolors.ENDC} per host, up to -N {max_concurrent_fragments}.\n")
+
+    return current_download_directory
+
+# Sets up the session's bandwidth governor, and says what it allows
+def start_bandwidth_governor():
+    global bandwidth_governor
+    bandwidth_governor = BandwidthGovernor()
+    budget = bandwidth_governor.budget()
+    if budget is not None:
+        print(f"Bandwidth is limited to {bcolors.COMPLETED}{format_bytes(budget)}/s{bcolors.ENDC} across all downloads.\n")
+    elif bandwidth_governor.schedule:
+        print(f"Bandwidth is {bcolors.COMPLETED}unlimited{bcolors.ENDC} now, rate_schedule limits it at other times.\n")
+
+# Returns the directory a queue item downloads into. With the temporary folder every item gets its
+# own workspace in it, named after the item so a resumed download finds its partial files again.
+def job_directory(item_id):
+    if use_temp_folder:
+        return os.path.join(os.path.expanduser(temp_download_directory), f"job-{item_id}")
+    return os.path.expanduser(download_directory)
+
+# Returns how many bytes a link's download needs on disk, from the format sizes in its prefetched
+# info, or None if they aren't known. Formats that are merged need room for the merged file too.
+def estimated_download_size(link):
+    info_path = cached_info_path(link)
+    if info_path is None:
+        return None
+    try:
+        with open(info_path, 'r') as f:
+            info = json.load(f)
+    except (OSError, ValueError):
+        return None
+    formats = info.get("requested_formats") or [info]
+    sizes = [download_format.get("filesize") or download_format.get("filesize_approx") for download_format in formats]
+    if not all(sizes):
+        return None
+    return sum(sizes) * 2 if len(formats) > 1 else sum(sizes)
+
+# Returns how many more bytes a running job is expected to write. Once yt-dlp has printed the size
+# of the file it is downloading, that replaces the estimate if it is larger.
+def remaining_download_bytes(job):
+    written = job.finished_bytes + job.downloaded_bytes
+    expected = job.estimated_size or 0
+    if job.total_bytes:
+        expected = max(expected, job.finished_bytes + job.total_bytes)
+    return max(expected - written, 0)
+
+# Returns the directory downloads are written to, the temporary folder or the final directory
+def download_space_directory():
+    return os.path.expanduser(temp_download_directory if use_temp_folder else download_directory)
+
+# Returns whether a job fits in the directory downloads go to, next to what the running jobs are
+# still expected to write, keeping temp_min_free_mb free. A job whose size isn't known only needs
+# that margin. Without the temporary folder, the margin is kept in the final directory.
+def fits_on_disk(job, running_jobs):
+    free = shutil.disk_usage(download_space_directory()).free - temp_min_free_mb * 1024 * 1024
+    free -= sum(remaining_download_bytes(running_job) for running_job in running_jobs)
+    return free >= (job.estimated_size or 0)
+
+# Returns the error of a job that won't fit on disk however long it waits, or None. It never fits
+# if it needs more than the whole disk, margin included, and it won't fit any time soon if there's
+# no download or move left running that could free space.
+def disk_space_error(job, can_free):
+    directory = download_space_directory()
+    needed = (job.estimated_size or 0) + temp_min_free_mb * 1024 * 1024
+    if needed > shutil.disk_usage(directory).total:
+        return f"ERROR: Needs {format_bytes(needed)} with temp_min_free_mb, more than the disk of {directory} holds"
+    if not can_free:
+        return f"ERROR: Not enough free space in {directory}, and no download or move is running that could free it"
+    return None
+
+# Says why a job is waiting for disk space
+def disk_space_message(job):
+    if job.estimated_size:
+        return f"Waiting for {format_bytes(job.estimated_size)} of free space"
+    return f"Waiting for more than {temp_min_free_mb}MB of free space"
+
+# Holds a job back until it fits on disk, while the moves still running free up the temporary
+# folder. Returns the error to fail the job with if it doesn't fit once they are done, or never
+# can, else None.
+def wait_for_disk_space(job, mover):
+    if fits_on_disk(job, []):
+        return None
+    error = disk_space_error(job, mover is not None and mover.moving())
+    if error is not None:
+        return error
+    print(f"{bcolors.OKSTATUS}{disk_space_message(job)}:{bcolors.ENDC} {job.link}")
+    while not fits_on_disk(job, []):
+        if not mover.wait_for_move():
+            return disk_space_error(job, False)
+    return None
+
+# Holds the state of a single link while it is being downloaded
+class DownloadJob:
+    def __init__(self, link, slot, item_id=None, directory=None, resume=False):
+        self.link = link
+        self.slot = slot
+        self.item_id = item_id
+        self.directory = directory
+        self.resume = resume
+        self.state = None
+        self.host = urlparse(link).hostname or "?"
+        self.status = "Waiting for a worker"
+        self.border = "green"
+        self.item_number = "?"
+        self.total_items = "?"
+        self.succeeded = False
+        self.pending_line = None
+        self.pending_record = None
+        self.changed = True
+        self.downloaded_bytes = 0
+        self.total_bytes = None
+        self.concurrent_fragments = None
+        self.speed_samples = []
+        self.state_times = {}
+        self.first_output_at = None
+        self.errors = []
+        self.retry_at = None
+        self.first_progress_at = None
+        self.finished_bytes = 0
+        self.peak_speed = 0
+        self.fragment_count = 0
+        self.estimated_size = None
+        self.rate = None
+        self.rate_changed = False
+        self.progress_record = None
+
+    # Sets the status shown for this job and marks it for the next frame
+    def set_status(self, status, border):
+        self.status = status
+        self.border = border
+        self.pending_line = None
+        self.pending_record = None
+        self.changed = True
+
+# Updates a job's status from one line of yt-dlp output. Returns whether anything changed. The
+# sizes and speed in a progress line are only turned into numbers by track_progress_record, once
+# per frame, as nothing needs them more often.
+def update_job_from_line(job, line):
+    record = parse_progress_line(line)
+    if record is None:
+        return False
+    apply_progress_record(job, record)
+    if record.percent is not None:
+        if job.first_progress_at is None:
+            job.first_progress_at = time.monotonic()
+        job.progress_record = record
+    return True
+
+# Updates the byte counts and speed samples of a job from its latest progress line, if there is
+# a new one since the last time
+def track_progress_record(job):
+    record = job.progress_record
+    if record is None:
+        return
+    job.progress_record = None
+    total_bytes = parse_rate(record.total_size) if record.total_size else None
+    downloaded_bytes = int(float(record.percent) * total_bytes / 100) if total_bytes else 0
+    speed = parse_speed(record.speed) if record.speed else None
+    track_job_progress(job, downloaded_bytes, total_bytes, speed, record.total_fragments)
+    if tune_fragments and record.fragment and speed:
+        job.speed_samples.append(speed)
+
+# Keeps the totals the event log reports for a job up to date from one progress update. A byte
+# count lower than the last one means the next file started, so the last one is counted as finished.
+def track_job_progress(job, downloaded_bytes, total_bytes, speed, total_fragments):
+    if job.first_progress_at is None:
+        job.first_progress_at = time.monotonic()
+    if downloaded_bytes < job.downloaded_bytes:
+        job.finished_bytes += job.total_bytes or job.downloaded_bytes
+    job.downloaded_bytes = downloaded_bytes
+    job.total_bytes = total_bytes
+    if speed:
+        job.peak_speed = max(job.peak_speed, speed)
+    if total_fragments:
+        job.fragment_count = max(job.fragment_count, int(total_fragments))
+
+# Updates a job's status from a parsed progress record
+def apply_progress_record(job, record):
+    if record.kind == "item":
+        job.item_number = record.item_number
+        job.total_items = record.total_items
+    job.status = format_progress_status(record, job)
+    job.border = "blue" if record.kind == "merge" else "cyan"
+    if record.kind == "merge":
+        record_job_state(job, "merging")
+
+# Takes in one line of yt-dlp output for a job. Progress lines only replace the job's pending
+# line and are parsed when the next frame is drawn, so lines between frames are merged into one
+# update. The rare lines that change state are applied right away.
+def ingest_job_line(job, line):
+    if job.first_output_at is None:
+        job.first_output_at = time.monotonic()
+    if "%" in line and line.lstrip().startswith("[download]"):
+        job.pending_line = line
+        job.changed = True
+    elif line.startswith("ERROR:"):
+        job.errors.append(line)
+    elif update_job_from_line(job, line):
+        job.pending_line = None
+        job.changed = True
+
+# Applies a job's latest pending progress line or hook record, if there is one
+def flush_job_line(job):
+    if job.pending_line is not None:
+        update_job_from_line(job, job.pending_line)
+        job.pending_line = None
+    track_progress_record(job)
+    record = job.pending_record
+    if record is not None:
+        job.pending_record = None
+        apply_progress_record(job, record)
+
+# Redraws a Live panel at a fixed frame rate from its own task, and only when a job or the
+# session changed since the last frame. get_jobs returns the jobs shown, build_panel the panel.
+class FrameRenderer:
+    def __init__(self, live, get_jobs, build_panel):
+        self.live = live
+        self.get_jobs = get_jobs
+        self.build_panel = build_panel
+        self.changed = True
+
+    # Marks the panel for redrawing on the next frame
+    def mark_changed(self):
+        self.changed = True
+
+    # Parses pending lines and redraws the panel if anything changed
+    def draw(self):
+        for job in self.get_jobs():
+            if job.changed:
+                flush_job_line(job)
+                job.changed = False
+                self.changed = True
+        if self.changed:
+            self.changed = False
+            self.live.update(self.build_panel(), refresh=True)
+
+    # Draws a frame every 1/ui_refresh_rate seconds until cancelled
+    async def run(self):
+        interval = 1 / max(ui_refresh_rate, 1)
+        while True:
+            await asyncio.sleep(interval)
+            self.draw()
+
+# Reads a child's output and puts each line on the event queue. yt-dlp redraws progress with
+# carriage returns, so lines are split on those as well as on newlines.
+async def read_process_output(job, process, events):
+    buffer = b""
+    while True:
+        chunk = await process.stdout.read(65536)
+        if not chunk:
+            break
+        buffer += chunk
+        *lines, buffer = line_break_pattern.split(buffer)
+        for line in lines:
+            if line:
+                await events.put((job, line.decode(errors="replace")))
+    if buffer:
+        await events.put((job, buffer.decode(errors="replace")))
+
+# Takes lines off the event queue and hands them to their jobs. Nothing is drawn here.
+async def consume_output_events(events):
+    while True:
+        job, line = await events.get()
+        try:
+            ingest_job_line(job, line)
+        finally:
+            events.task_done()
+
+# Starts yt-dlp for a job in its directory and feeds its output into the event queue. Returns the
+# exit code. When the session has a bandwidth limit, a process whose share of it changed is stopped
+# and started again with --continue and the new -r, picking up its partial files.
+async def run_process(job, command, events):
+    while True:
+        if command is None:
+            return None
+        process = await asyncio.create_subprocess_exec(
+            *command,
+            cwd=os.path.expanduser(job.directory),
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+        )
+        watcher = asyncio.create_task(watch_process_rate(job, process)) if bandwidth_governor is not None and bandwidth_governor.limited() else None
+        try:
+            await read_process_output(job, process, events)
+            returncode = await process.wait()
+        finally:
+            if watcher is not None:
+                watcher.cancel()
+        # A process that exited on its own before the watcher stopped it has finished
+        rate_changed, job.rate_changed = job.rate_changed, False
+        if not rate_changed or returncode != -signal.SIGTERM:
+            return returncode
+        job.resume = True
+        # What the stopped process recorded goes into the archive first, so the new archive file has it
+        import_job_archive(job_archive_path(job))
+        command = await asyncio.to_thread(build_download_command, job)
+
+# Stops a job's yt-dlp process once its share of the bandwidth limit has been different from its
+# -r for two checks in a row, so a download finishing just before the next one starts doesn't
+# restart the others. Processes already merging are left to finish.
+async def watch_process_rate(job, process):
+    proposed = job.rate
+    while True:
+        await asyncio.sleep(rate_check_interval)
+        if job.state == "merging":
+            return
+        rate = bandwidth_governor.process_rate(job, job.concurrent_fragments or configured_concurrent_fragments())
+        if rate == job.rate or rate != proposed:
+            proposed = rate
+            continue
+        if process.returncode is not None:
+            return
+        try:
+            process.terminate()
+        except ProcessLookupError:
+            return
+        log_event("rate_changed", item_id=job.item_id, link=job.link, old_rate=job.rate, rate=rate)
+        job.rate_changed = True
+        return
+
+# Builds the progress panel for a single job
+def render_job_panel(job):
+    return Panel(job.status, title = "Download Progress", border_style = job.border)
+
+# Runs a single download on the asyncio engine, drawing its progress into the Live panel
+async def stream_download(job, command, live):
+    renderer = FrameRenderer(live, lambda: [job], lambda: render_job_panel(job))
+    events = asyncio.Queue(maxsize=output_event_queue_size)
+    consumer = asyncio.create_task(consume_output_events(events))
+    frames = asyncio.create_task(renderer.run())
+    try:
+        returncode = await run_process(job, command, events)
+        await events.join()
+    finally:
+        consumer.cancel()
+        frames.cancel()
+    renderer.draw()
+    return returncode
+
+# Formats a byte count the way yt-dlp prints it, e.g. 1.68GiB
+def format_bytes(byte_count):
+    for unit in ("B", "KiB", "MiB", "GiB", "TiB"):
+        if byte_count < 1024 or unit == "TiB":
+            return f"{byte_count:.2f}{unit}"
+        byte_count /= 1024
+
+# Formats a number of seconds as mm:ss, or hh:mm:ss when it is an hour or more
+def format_eta(seconds):
+    if seconds is None:
+        return None
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours:02d}:{minutes:02d}:{seconds:02d}"
+    return f"{minutes:02d}:{seconds:02d}"
+
+# Builds a progress record from a yt-dlp progress hook, using its exact byte counts
+def progress_record_from_hook(progress, info):
+    downloaded_bytes = progress.get("downloaded_bytes") or 0
+    total_bytes = progress.get("total_bytes") or progress.get("total_bytes_estimate")
+    percent = f"{downloaded_bytes / total_bytes * 100:.1f}" if total_bytes else None
+    total_size = format_bytes(total_bytes) if total_bytes else None
+    speed = f"{format_bytes(progress['speed'])}/s" if progress.get("speed") else None
+    fragment = progress.get("fragment_index")
+    total_fragments = progress.get("fragment_count")
+    kind = "audio" if info.get("vcodec") == "none" else "video"
+    return ProgressRecord(kind, percent, total_size, speed, format_eta(progress.get("eta")),
+                          str(fragment) if fragment is not None else None,
+                          str(total_fragments) if total_fragments else None)
+
+# Imports yt_dlp and builds the session's YoutubeDL params for the embedded engine. Returns
+# False, after saying why, if that is not possible, so the caller can use the subprocess engine.
+def load_embedded_engine():
+    global yt_dlp
+    global embedded_params
+    try:
+        yt_dlp = importlib.import_module("yt_dlp")
+    except ImportError:
+        print(f"{bcolors.ERROR}Error:{bcolors.ENDC} The embedded engine needs the yt_dlp Python package. Using the subprocess engine.\n")
+        return False
+
+    # Turn the yt_dlp_options string into a params dict with yt-dlp's own option parser
+    arguments = yt_dlp_options.split()
+    try:
+        params = yt_dlp.parse_options(arguments).ydl_opts
+    except SystemExit:
+        print(f"{bcolors.ERROR}Error:{bcolors.ENDC} yt-dlp could not parse the options {yt_dlp_options}. Using the subprocess engine.\n")
+        return False
+
+    params["paths"] = dict(params.get("paths") or {})
+    if not params.get("download_archive"):
+        params["download_archive"] = DownloadArchive()
+    if suppress_output:
+        params["quiet"] = True
+        params["noprogress"] = True
+        params["no_warnings"] = True
+    embedded_params = params
+    del embedded_workers[:]
+    print(f"Download engine is {bcolors.COMPLETED}embedded{bcolors.ENDC}, using yt-dlp {yt_dlp.version.__version__}.\n")
+    return True
+
+# Runs downloads on the embedded engine. Every link gets a fresh YoutubeDL, as the exit code of a
+# failed download sticks on the instance, but the extractors the worker's earlier links used are
+# handed on to it, so they are only set up once and keep what they cached. Progress comes from
+# yt-dlp's hooks instead of its text output.
+class EmbeddedWorker:
+    def __init__(self, params):
+        self.job = None
+        self.params = dict(params)
+        self.home = self.params["paths"].get("home")
+        self.continuedl = self.params.get("continuedl", True)
+        self.params["progress_hooks"] = [self.on_progress]
+        self.params["postprocessor_hooks"] = [self.on_postprocess]
+        self.extractors = {}
+        self.extractor_keys = set()
+
+    # Builds the YoutubeDL for a job's link
+    def new_downloader(self, job):
+        params = dict(self.params)
+        # Each job downloads into its own directory, unless the options set one with -P home:
+        params["paths"] = dict(params["paths"], home=self.home or os.path.expanduser(job.directory))
+        params["continuedl"] = job.resume or self.continuedl
+        if tune_fragments:
+            job.concurrent_fragments = tuned_concurrent_fragments(job.host)
+            params["concurrent_fragment_downloads"] = job.concurrent_fragments
+        ydl = yt_dlp.YoutubeDL(params)
+        for extractor in self.extractors.values():
+            ydl.add_info_extractor(extractor)
+        return ydl
+
+    # Downloads a job's link, returning 0 on success like the yt-dlp executable would
+    def download(self, job):
+        self.job = job
+        info_path = cached_info_path(job.link)
+        try:
+            with self.new_downloader(job) as ydl:
+                try:
+                    if info_path:
+                        return ydl.download_with_info_file(info_path)
+                    return ydl.download([job.link])
+                except yt_dlp.utils.DownloadError as e:
+                    job.errors.append(str(e))
+                    return 1
+                finally:
+                    for key in self.extractor_keys:
+                        self.extractors[key] = ydl.get_info_extractor(key)
+        finally:
+            self.job = None
+
+    # Called by yt-dlp from the download thread. Only stores the latest state for the next frame.
+    def on_progress(self, progress):
+        job = self.job
+        if job is None or progress.get("status") != "downloading":
+            return
+        info = progress.get("info_dict") or {}
+        if info.get("extractor_key"):
+            self.extractor_keys.add(info["extractor_key"])
+        if info.get("playlist_index") and info.get("n_entries"):
+            job.item_number = str(info["playlist_index"])
+            job.total_items = str(info["n_entries"])
+        downloaded_bytes = progress.get("downloaded_bytes") or 0
+        if bandwidth_governor is not None:
+            # A count lower than the last one means the next file started
+            bandwidth_governor.consume(downloaded_bytes - job.downloaded_bytes if downloaded_bytes >= job.downloaded_bytes else downloaded_bytes)
+        track_job_progress(job, downloaded_bytes, progress.get("total_bytes") or progress.get("total_bytes_estimate"), progress.get("speed"), progress.get("fragment_count"))
+        if tune_fragments and progress.get("fragment_index") and progress.get("speed"):
+            job.speed_samples.append(progress["speed"])
+        job.pending_record = progress_record_from_hook(progress, info)
+        job.changed = True
+
+    def on_postprocess(self, progress):
+        job = self.job
+        if job is not None and progress.get("status") == "started" and progress.get("postprocessor") == "Merger":
+            record_job_state(job, "merging")
+            job.pending_record = ProgressRecord("merge")
+            job.changed = True
+
+# Hands out an idle embedded worker, creating one if every worker is busy
+def acquire_embedded_worker():
+    with embedded_workers_lock:
+        if embedded_workers:
+            return embedded_workers.pop()
+    return EmbeddedWorker(embedded_params)
+
+# Returns a worker to the idle list so the next job reuses its YoutubeDL instance
+def release_embedded_worker(worker):
+    with embedded_workers_lock:
+        embedded_workers.append(worker)
+
+# Runs a single download on the embedded engine, drawing its progress into the Live panel
+async def stream_embedded_download(worker, job, live):
+    renderer = FrameRenderer(live, lambda: [job], lambda: render_job_panel(job))
+    frames = asyncio.create_task(renderer.run())
+    try:
+        returncode = await asyncio.to_thread(worker.download, job)
+    finally:
+        frames.cancel()
+    renderer.draw()
+    return returncode
+
+# Puts back the downloads a killed session left behind and says so. With resume, returns them
+# to be downloaded first, in the directory they were started in if it is still there.
+def recover_interrupted_downloads(resume):
+    prune_journal()
+    import_job_archives()
+    interrupted = release_stale_claims()
+    if not interrupted:
+        return []
+    if not resume:
+        print(f"{bcolors.OKSTATUS}{len(interrupted)} interrupted downloads were put back in the queue.{bcolors.ENDC} Use start --resume to continue them first.\n")
+        return []
+    print(f"{bcolors.OKSTATUS}Resuming {len(interrupted)} interrupted downloads:{bcolors.ENDC}")
+    for item in interrupted:
+        print(f"  {item['link']} (last state: {item['state']})")
+        if item["directory"] and not os.path.isdir(item["directory"]):
+            item["directory"] = None
+    print(f"")
+    return interrupted
+
+# Records that a job's download starts, in the journal, the event log and the metrics
+def begin_download(job):
+    record_job_state(job, "downloading")
+    if bandwidth_governor is not None:
+        bandwidth_governor.add_download(job)
+    add_metric("yt_dlp_sc_active_downloads", 1)
+    log_event("download_started", item_id=job.item_id, link=job.link, host=job.host, engine=engine, resume=job.resume)
+
+# Logs how a job's download ended, with its timings and totals, and records its phases for the
+# profile. Timings are in seconds and speeds in bytes per second. Downloads that never started,
+# like archived links, are logged as skipped.
+def log_download_result(job, exit_code):
+    if bandwidth_governor is not None:
+        bandwidth_governor.remove_download(job)
+    # The last lines of output may have come in after the last frame
+    flush_job_line(job)
+    ended = time.monotonic()
+    started = job.state_times.get("downloading")
+    if started is None:
+        log_event("download_skipped", item_id=job.item_id, link=job.link, host=job.host)
+        return
+    result = "finished" if exit_code == 0 else "failed"
+    seconds = ended - started
+    merge_started = job.state_times.get("merging")
+    fields = {
+        "item_id": job.item_id,
+        "link": job.link,
+        "host": job.host,
+        "exit_code": exit_code,
+        "seconds": round(seconds, 3),
+        "startup_seconds": None,
+        "merge_seconds": round(ended - merge_started, 3) if merge_started else None,
+        "bytes": None,
+        "average_speed": None,
+        "peak_speed": None,
+        "fragments": job.fragment_count or None,
+        "concurrent_fragments": job.concurrent_fragments,
+    }
+    add_metric("yt_dlp_sc_active_downloads", -1)
+    add_metric("yt_dlp_sc_downloads_total", 1, host=job.host, result=result)
+    add_metric("yt_dlp_sc_download_seconds_total", seconds, host=job.host)
+    record_phase("job", seconds)
+    if merge_started:
+        add_metric("yt_dlp_sc_merge_seconds_total", ended - merge_started, host=job.host)
+        record_phase("merge", ended - merge_started)
+    # Without parsed progress, as with the subprocess engine showing yt-dlp's own output, only the timings are known
+    if job.first_progress_at is not None:
+        # A finished download got all of its last file, even if the last progress update came before the end
+        byte_count = job.finished_bytes + (job.total_bytes if exit_code == 0 and job.total_bytes else job.downloaded_bytes)
+        transfer_seconds = (merge_started or ended) - job.first_progress_at
+        fields["startup_seconds"] = round(job.first_progress_at - started, 3)
+        fields["bytes"] = byte_count
+        fields["average_speed"] = round(byte_count / transfer_seconds) if transfer_seconds > 0 else None
+        fields["peak_speed"] = round(job.peak_speed) or None
+        add_metric("yt_dlp_sc_download_startup_seconds_total", job.first_progress_at - started, host=job.host)
+        # Output before the first progress line means yt-dlp is up and extracting, the embedded engine has no startup of its own
+        if job.first_output_at is not None and job.first_output_at <= job.first_progress_at:
+            record_phase("yt-dlp startup", job.first_output_at - started)
+            record_phase("extraction", job.first_progress_at - job.first_output_at)
+        else:
+            record_phase("extraction", job.first_progress_at - started)
+        record_phase("download", transfer_seconds)
+        add_metric("yt_dlp_sc_downloaded_bytes_total", byte_count, host=job.host)
+        add_metric("yt_dlp_sc_fragments_total", job.fragment_count, host=job.host)
+        if session_metrics is not None:
+            key = ("yt_dlp_sc_peak_speed_bytes", (("host", job.host),))
+            set_metric("yt_dlp_sc_peak_speed_bytes", max(session_metrics.get(key, 0), round(job.peak_speed)), host=job.host)
+    log_event(f"download_{result}", **fields)
+
+# Records a finished download. With the temporary folder its item stays claimed until its files
+# are moved, so a session killed in between still has it in the queue.
+def finish_download(job):
+    import_job_archive(job_archive_path(job))
+    log_download_result(job, 0)
+    if tune_fragments:
+        record_fragment_throughput(job)
+    if use_temp_folder:
+        record_job_state(job, "downloaded")
+    else:
+        finish_queue_item(job.item_id)
+
+# Returns whether a failed job's error is permanent, and the reason it failed: the first
+# permanent error yt-dlp printed, else its last error
+def classify_failure(job, exit_code):
+    errors = [error.removeprefix("ERROR:").strip() for error in job.errors]
+    for error in errors:
+        if permanent_error_pattern.search(error):
+            return True, error
+    if errors:
+        return False, errors[-1]
+    return False, f"yt-dlp exited with code {exit_code}" if exit_code is not None else "yt-dlp could not be run"
+
+# Returns how long to wait before retrying a download after the given number of attempts:
+# retry_backoff seconds doubled for every attempt after the first, up to retry_backoff_max.
+# A random part of up to half of it is taken off, so links that failed together don't all retry together.
+def retry_delay(attempts):
+    delay = min(retry_backoff * 2 ** max(attempts - 1, 0), retry_backoff_max)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+# Records a failed download. Whatever it did download is still added to the download archive.
+# Transient failures go back in the queue to be retried after a backoff, up to max_retries times,
+# and permanent ones or ones out of retries go to the failed list. exit_code is yt-dlp's, or None
+# if it could not be run. Returns what happens to the link, to be shown to the user.
+def fail_download(job, exit_code=None):
+    import_job_archive(job_archive_path(job))
+    log_download_result(job, exit_code)
+    permanent, reason = classify_failure(job, exit_code)
+    attempts = queue_item_attempts(job.item_id)
+    if not permanent and attempts <= max_retries:
+        delay = retry_delay(attempts)
+        job.retry_at = time.time() + delay
+        fail_queue_item(job.item_id, reason, job.retry_at)
+        add_metric("yt_dlp_sc_retries_total", 1, host=job.host)
+        log_event("retry_scheduled", item_id=job.item_id, link=job.link, attempts=attempts, delay=round(delay, 1), reason=reason)
+        return f"Retrying in {delay:.0f} seconds, attempt {attempts + 1} of {max_retries + 1}: {reason}"
+    fail_queue_item(job.item_id, reason)
+    add_metric("yt_dlp_sc_failed_total", 1, host=job.host)
+    log_event("failed", item_id=job.item_id, link=job.link, attempts=attempts, permanent=permanent, reason=reason)
+    if permanent:
+        return f"Not retrying, moved to the failed list: {reason}"
+    return f"Gave up after {attempts} attempts, moved to the failed list: {reason}"
+
+# Records a finished download whose files could not be moved. Like a failed download it waits
+# out a backoff before it is claimed again, up to max_retries times counted apart from its download
+# attempts, and then goes to the failed list, so a full or broken final directory isn't retried
+# over and over. When it is claimed again, the download archive makes it skip the download and
+# only the move is tried again. Returns what happens to the link, to be shown to the user.
+def fail_move(job, reason):
+    attempts = queue_item_move_attempts(job.item_id) + 1
+    if attempts <= max_retries:
+        delay = retry_delay(attempts)
+        fail_queue_item_move(job.item_id, reason, time.time() + delay)
+        log_event("retry_scheduled", item_id=job.item_id, link=job.link, move_attempts=attempts, delay=round(delay, 1), reason=reason)
+        return f"Moving {job.link} again in {delay:.0f} seconds, attempt {attempts + 1} of {max_retries + 1}. Its files are kept in {job.directory}"
+    fail_queue_item_move(job.item_id, reason)
+    log_event("failed", item_id=job.item_id, link=job.link, move_attempts=attempts, permanent=False, reason=reason)
+    return f"Gave up moving {job.link} after {attempts} attempts, moved to the failed list. Its files are kept in {job.directory}"
+
+# Holds a sequential session until the next failed link is due to be retried
+def wait_for_retry(retry_at):
+    delay = max(retry_at - time.time(), 0)
+    print(f"{bcolors.OKSTATUS}Waiting {delay:.0f} seconds to retry failed downloads.{bcolors.ENDC}\n")
+    time.sleep(delay)
+
+# Records that a finished download's files were moved to the final directory
+def finish_moved_download(job):
+    record_job_state(job, "moved")
+    finish_queue_item(job.item_id)
+
+# Starts the downloading of each link in queue, sequentially.
+def download_queue(resume=False):
+    global download_directory
+    global temp_download_directory
+    global suppress_output
+
+    load_session_modules()
+    current_download_directory = print_session_header()
+    start_session_metrics()
+    start_bandwidth_governor()
+    use_embedded = engine == "embedded" and load_embedded_engine()
+    resumed = recover_interrupted_downloads(resume)
+    expand_playlists()
+    validate_queue(load_queue())
+    mover = None
+
+    while True:
+        # Claim the interrupted links first when resuming, then the first waiting link in the queue
+        item = None
+        while resumed and item is None:
+            candidate = resumed.pop(0)
+            if claim_queue_item(candidate["id"]):
+                item = candidate
+        if item is not None:
+            job = DownloadJob(item["link"], 0, item["id"], item["directory"] or job_directory(item["id"]), resume=True)
+        else:
+            item = claim_next_queue_item()
+            if item is None:
+                # Links waiting to be retried keep the session going until their time comes
+                retry_at = next_retry_time()
+                if retry_at is None:
+                    break
+                wait_for_retry(retry_at)
+                continue
+            job = DownloadJob(item["link"], 0, item["id"], job_directory(item["id"]))
+        link = job.link
 
         print(f"{bcolors.OKSTATUS}Checking Queue URL:{bcolors.ENDC} {link}")
         if "www.youtube.com/" in link:
             print(f"{bcolors.COMPLETED}URL looks like it belongs to Youtube.{bcolors.ENDC}\n")
-            print(f"{bcolors.OKSTATUS}Checking responsiveness{bcolors.ENDC}")
             link_valid = True
-            if check_ping(link):
+            error = ping_error(link)
+            if error is None:
                 print(f"{bcolors.COMPLETED}URL is responsive. Proceeding with download.{bcolors.ENDC}\n")
+                record_job_state(job, "validated")
 
                 link_responsive = True
-            elif not check_ping(link):
+            elif url_is_gone(error):
                 print(f"{bcolors.ERROR}Removing URL:{bcolors.ENDC} {link}\n")
                 link_responsive = False
-                queue.pop(0)
-                save_queue()
+                finish_queue_item(item["id"], "removed")
+            # A link that didn't answer is retried like a failed download
+            else:
+                job.errors.append(f"ERROR: URL check failed: {error}")
+                print(f"{bcolors.ERROR}URL check failed:{bcolors.ENDC} {link}")
+                print(f"{fail_download(job)}\n")
+                continue
         elif "www.youtube.com/" not in link:
             print(f"{bcolors.ERROR}Removing URL:{bcolors.ENDC} {link}\n")
             link_valid = False
-            queue.pop(0)
-            save_queue()
+            finish_queue_item(item["id"], "removed")
 
         if link_valid and link_responsive:
             if use_temp_folder:
@@ -578,101 +2604,675 @@ def download_queue():
                         if debug:
                             print(f"DEBUG Error 40: Unable to write to ~/Downloads")
                             return
+                if mover is None:
+                    mover = FileMover(temp_download_directory)
+                os.makedirs(job.directory, exist_ok=True)
+
+            # Videos already in the download archive are not downloaded again
+            if is_archived_link(link):
+                print(f"{bcolors.OKSTATUS}Already downloaded:{bcolors.ENDC} {link}\n")
+                finish_download(job)
+                if use_temp_folder:
+                    mover.submit(job)
+                continue
+
+            job.estimated_size = estimated_download_size(link)
+            error = wait_for_disk_space(job, mover)
+            if error is not None:
+                job.errors.append(error)
+                print(f"{bcolors.ERROR}Not enough disk space for:{bcolors.ENDC} {link}")
+                print(f"{fail_download(job)}\n")
+                continue
+            command = None if use_embedded else build_download_command(job)
+            begin_download(job)
+
+            if not use_embedded and command is None:
+                print(f"{bcolors.ERROR}Error occurred while downloading:{bcolors.ENDC} {link}")
+                print(f"{fail_download(job)}\n")
+                continue
+
+            elif use_embedded:
+                worker = acquire_embedded_worker()
+                # Anything yt-dlp raises beyond its own download errors fails the link, so its claim isn't left behind
+                try:
+                    if suppress_output:
+                        with Live(render_job_panel(job), auto_refresh = False) as live:
+                            job.set_status("Fetching download information", "green")
+                            returncode = asyncio.run(stream_embedded_download(worker, job, live))
+                    else:
+                        returncode = worker.download(job)
+                except Exception as e:
+                    job.errors.append(str(e))
+                    returncode = None
+                finally:
+                    release_embedded_worker(worker)
+
+                if returncode == 0:
+                    print(f"{bcolors.OKSTATUS}Finished downloading:{bcolors.ENDC} {link}\n")
+                    finish_download(job)
+                else:
+                    print(f"{bcolors.ERROR}Error occurred while downloading:{bcolors.ENDC} {link}")
+                    print(f"{fail_download(job, returncode)}\n")
+                    continue
 
-                download_archive = f"{os.path.expanduser(current_download_directory)}/downloaded_videos.txt"
-                command = ["yt-dlp", "--download-archive", download_archive] + yt_dlp_options.split() + [link]
-                if debug:
-                    print(f"{bcolors.OKSTATUS}Command (pretty):{bcolors.ENDC} {' '.join(command)}\n")
-                    print(f"{bcolors.OKSTATUS}Command (raw):{bcolors.ENDC} {command}\n")
-
-            elif not use_temp_folder:
-                command = ["yt-dlp"] + yt_dlp_options.split() + [link]
-                if debug:
-                    print(f"{bcolors.OKSTATUS}Command (pretty):{bcolors.ENDC} {' '.join(command)}\n")
-                    print(f"{bcolors.OKSTATUS}Command (raw):{bcolors.ENDC} {command}\n")
-
-            if suppress_output:
+            elif suppress_output:
                 initial_panel = Panel("Fetching download information", border_style="green")
-                with Live(initial_panel, refresh_per_second = 5) as live:
+                with Live(initial_panel, auto_refresh = False) as live:
+                    job.set_status("Fetching download information", "green")
                     try:
-                        process = subprocess.Popen(
-                            command,
-                            cwd=os.path.expanduser(current_download_directory),
-                            stdout=subprocess.PIPE,
-                            stderr=subprocess.STDOUT,
-                            text=True,
-                        )
-
-                        panel = Panel("Downloading...", border_style="green")
-                        live.update(initial_panel)
-
-                        # Process yt-dlp output in real-time
-                        for line in process.stdout:
-                            if ("[download]" in line and "%" in line and "ETA" in line) or ("Downloading item" in line):
-                                formatted_line = format_video_download_status(line)
-                                panel = Panel(formatted_line, title = "Download Progress", border_style = "cyan")
-                                live.update(panel)
-                            if ("[download]" in line and "%" in line and "ETA" in line and not "frag" in line):
-                                formatted_line = format_audio_download_status(line)
-                                panel = Panel(formatted_line, title = "Download Progress", border_style = "cyan")
-                                live.update(panel)
-                            if "[Merger]" in line and "Merging" in line:
-                                formatted_line = format_merging_status(line)
-                                panel = Panel(formatted_line, title = "Download Progress", border_style = "blue")
-                                live.update(panel)
-
-                        print(f"{bcolors.OKSTATUS}Finished downloading:{bcolors.ENDC} {link}\n")
-                        queue.pop(0)
-                        save_queue()
-
-                    except subprocess.CalledProcessError as e:
-                        stderr_output = e.stderr.decode().strip()
-                        print(f"{bcolors.ERROR}Error occurred while downloading: {stderr_output}{bcolors.ENDC}")
-                        break
+                        returncode = asyncio.run(stream_download(job, command, live))
+                    except OSError as e:
+                        job.errors.append(str(e))
+                        returncode = None
+
+                if returncode == 0:
+                    print(f"{bcolors.OKSTATUS}Finished downloading:{bcolors.ENDC} {link}\n")
+                    finish_download(job)
+                else:
+                    print(f"{bcolors.ERROR}Error occurred while downloading:{bcolors.ENDC} {link}")
+                    print(f"{fail_download(job, returncode)}\n")
+                    continue
 
             elif not suppress_output:
                 try:
-                    subprocess.run(command, check=True, cwd=os.path.expanduser(current_download_directory), stderr=subprocess.PIPE)
+                    subprocess.run(command, check=True, cwd=os.path.expanduser(job.directory), stderr=subprocess.PIPE)
                     print(f"{bcolors.OKSTATUS}Finished downloading:{bcolors.ENDC} {link}\n")
-                    queue.pop(0)
-                    save_queue()
+                    finish_download(job)
                 except subprocess.CalledProcessError as e:
                     stderr_output = e.stderr.decode().strip()
                     print(f"{bcolors.ERROR}Error occurred while downloading: {stderr_output}{bcolors.ENDC}")
-                    break
+                    job.errors += [line for line in stderr_output.splitlines() if line.startswith("ERROR:")]
+                    print(f"{fail_download(job, e.returncode)}\n")
+                    continue
 
-            # Move files from temp folder to final directory if temp folder was used
+            # Move this link's files from its workspace to final directory in the background, while the next one downloads
             if use_temp_folder:
-                move_files_to_final_directory(os.path.expanduser(temp_download_directory))
-        if os.path.expanduser("~/Downloads/yt-dlp-sc") in os.path.expanduser(temp_download_directory) and os.path.isdir(os.path.expanduser(temp_download_directory)):
-            os.rmdir(temp_download_directory)
+                mover.submit(job)
+
+    # Wait for the last files to be moved
+    if mover is not None:
+        move_files_to_final_directory(mover)
+
+# Checks that a link is a Youtube URL and that it responds. Returns None if it does, else why
+# not. Links that aren't Youtube URLs, or are gone, are removed, printing so.
+def validate_link(link):
+    if "www.youtube.com/" not in link:
+        print(f"{bcolors.ERROR}Removing URL:{bcolors.ENDC} {link}")
+        return "Not a Youtube URL"
+    error = ping_error(link)
+    if error is not None and url_is_gone(error):
+        print(f"{bcolors.ERROR}Removing URL:{bcolors.ENDC} {link}")
+    return error
+
+# Validates and downloads one link of a parallel session on the asyncio engine
+async def run_download_job(job, events, use_embedded):
+    job.set_status("Checking responsiveness", "green")
+    error = await asyncio.to_thread(validate_link, job.link)
+    if error is not None and ("www.youtube.com/" not in job.link or url_is_gone(error)):
+        job.set_status("Removed, URL is not valid or no longer exists", "red")
+        finish_queue_item(job.item_id, "removed")
+        return job
+    # A link that didn't answer is retried like a failed download
+    if error is not None:
+        job.errors.append(f"ERROR: URL check failed: {error}")
+        job.set_status(fail_download(job), "red")
+        return job
+    record_job_state(job, "validated")
+
+    os.makedirs(job.directory, exist_ok=True)
+    if is_archived_link(job.link):
+        job.set_status("Already downloaded", "green")
+        job.succeeded = True
+        finish_download(job)
+        return job
+
+    job.set_status("Fetching download information", "green")
+    begin_download(job)
+    if use_embedded:
+        worker = acquire_embedded_worker()
+        try:
+            returncode = await asyncio.to_thread(worker.download, job)
+        except Exception as e:
+            job.errors.append(str(e))
+            returncode = None
+        finally:
+            release_embedded_worker(worker)
+    else:
+        # Links that were not prefetched may be listed here, which takes a while, so it is kept off the event loop
+        command = await asyncio.to_thread(build_download_command, job)
+        returncode = await run_process(job, command, events)
+
+    if returncode == 0:
+        job.set_status("Finished downloading", "green")
+        job.succeeded = True
+        finish_download(job)
+    else:
+        job.set_status(fail_download(job, returncode), "red")
+    return job
+
+# Builds the combined multi-row panel for all running jobs
+def render_jobs_panel(jobs, finished_count, total_count):
+    table = Table.grid(padding=(0, 1))
+    table.add_column(justify="right", style="bold")
+    table.add_column(no_wrap=True, max_width=48, overflow="ellipsis")
+    table.add_column()
+    for job in sorted(jobs, key=lambda job: job.slot):
+        table.add_row(f"{job.slot}", job.link, f"[{job.border}]{job.status}[/{job.border}]")
+    return Panel(table, title=f"Download Progress ({finished_count}/{total_count} finished)", border_style="cyan")
+
+# Schedules the queued links onto the asyncio engine, at most `jobs` children at once.
+# Resumed links go first. With the temporary folder, each finished job's files are handed to the
+# mover straight away, and no new job starts while the folder is low on space. Failed links that
+# are retried go back on the pending list and start again once their backoff is over. Run by the
+# daemon, the session doesn't end when the queue is empty: it reads the queue again whenever it
+# wakes up, and only ends once it is told to stop and the running jobs are done.
+async def run_parallel_session(jobs, live, use_embedded, resumed, mover, daemon=None):
+    resumed_ids = {item["id"] for item in resumed}
+    pending = resumed + [item for item in queued_items() if item["id"] not in resumed_ids]
+    total_count = len(pending)
+    finished_count = 0
+    failed = []
+    running = {}
+    host_counts = {}
+    next_slot = 0
+    # Playlists that were listed already, so one that can't be listed isn't tried on every wake up
+    listed = {item["id"] for item in pending if is_playlist_link(item["link"])}
+    sizes = {}
+    held_ids = set()
+
+    renderer = FrameRenderer(live, lambda: list(running.values()), lambda: render_jobs_panel(running.values(), finished_count, total_count))
+    events = asyncio.Queue(maxsize=output_event_queue_size)
+    consumer = asyncio.create_task(consume_output_events(events))
+    frames = asyncio.create_task(renderer.run())
+    if daemon is not None:
+        daemon.snapshot = lambda: {"running": [{"link": job.link, "status": job.status} for job in running.values()],
+                                   "pending": len(pending), "finished": finished_count, "failed": len(failed)}
+    try:
+        while pending or running or (daemon is not None and not daemon.stopping):
+            # The daemon picks up the links added, removed or put back since it last looked, in queue
+            # order, after expanding new playlists
+            if daemon is not None:
+                daemon.wake.clear()
+                queued = queued_items()
+                playlists = {item["id"] for item in queued if is_playlist_link(item["link"])} - listed
+                if playlists:
+                    listed |= playlists
+                    await asyncio.to_thread(expand_playlists, playlists)
+                    queued = queued_items()
+                running_ids = {job.item_id for job in running.values()}
+                pending = [item for item in pending if item["id"] in resumed_ids] + [
+                    item for item in queued if item["id"] not in running_ids and item["id"] not in resumed_ids]
+                total_count = finished_count + len(running) + len(pending)
+            accepting = daemon is None or not (daemon.paused or daemon.stopping)
+
+            # Hand out links to free slots, skipping links whose host is at its cap, that are waiting
+            # to be retried, or that don't fit on disk next to the running jobs
+            now = time.time()
+            held = []
+            for item in list(pending):
+                if len(running) >= jobs or not accepting:
+                    break
+                if item.get("not_before", 0) > now:
+                    continue
+                if item["id"] in resumed_ids:
+                    job = DownloadJob(item["link"], next_slot, item["id"], item["directory"] or job_directory(item["id"]), resume=True)
+                else:
+                    job = DownloadJob(item["link"], next_slot, item["id"], job_directory(item["id"]))
+                if max_jobs_per_host and host_counts.get(job.host, 0) >= max_jobs_per_host:
+                    continue
+                if item["id"] not in sizes:
+                    sizes[item["id"]] = estimated_download_size(item["link"])
+                job.estimated_size = sizes[item["id"]]
+                if not fits_on_disk(job, running.values()):
+                    can_free = bool(running) or daemon is not None or (mover is not None and mover.moving())
+                    if item["id"] not in held_ids and disk_space_error(job, can_free) is None:
+                        print(f"{bcolors.OKSTATUS}{disk_space_message(job)}:{bcolors.ENDC} {job.link}")
+                        held_ids.add(item["id"])
+                    held.append((item, job))
+                    continue
+                pending.remove(item)
+                # Another invocation may have started this link in the meantime
+                if not claim_queue_item(item["id"]):
+                    total_count -= 1
+                    continue
+                host_counts[job.host] = host_counts.get(job.host, 0) + 1
+                next_slot += 1
+                running[asyncio.create_task(run_download_job(job, events, use_embedded))] = job
+            # Links that never fit fail, and so do the held ones once nothing is left that could free
+            # space, unless the daemon keeps waiting for space freed by hand
+            can_free = bool(running) or daemon is not None or (mover is not None and mover.moving())
+            for item, job in held:
+                error = disk_space_error(job, can_free)
+                if error is None:
+                    continue
+                pending.remove(item)
+                if not claim_queue_item(item["id"]):
+                    total_count -= 1
+                    continue
+                job.errors.append(error)
+                message = fail_download(job)
+                job.set_status(message, "red")
+                if job.retry_at is not None:
+                    pending.append({"id": job.item_id, "link": job.link, "not_before": job.retry_at})
+                    print(f"{bcolors.ERROR}Not downloaded yet:{bcolors.ENDC} {job.link} ({message})")
+                    continue
+                finished_count += 1
+                failed.append(job)
+                print(f"{bcolors.ERROR}Not downloaded:{bcolors.ENDC} {job.link} ({message})")
+            held = [entry for entry in held if entry[0] in pending]
+            renderer.mark_changed()
+
+            # Wake up when a job finishes or the next retry is due, whichever comes first. The daemon
+            # also wakes up when a client changes something, and every daemon_poll_interval seconds
+            # to notice links queued by other processes.
+            retry_times = [item["not_before"] for item in pending if item.get("not_before", 0) > now]
+            timeout = max(min(retry_times) - time.time(), 0) if retry_times else None
+            # Links held back for space are tried again as moves and downloads free it up
+            if held:
+                timeout = disk_space_poll_interval if timeout is None else min(timeout, disk_space_poll_interval)
+            waiting = set(running)
+            if daemon is not None:
+                wake = asyncio.create_task(daemon.wake.wait())
+                waiting.add(wake)
+                timeout = daemon_poll_interval if timeout is None else min(timeout, daemon_poll_interval)
+            if not waiting:
+                await asyncio.sleep(timeout or 0)
+                continue
+            done, _ = await asyncio.wait(waiting, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if daemon is not None:
+                wake.cancel()
+                done.discard(wake)
+            for task in done:
+                job = running.pop(task)
+                host_counts[job.host] -= 1
+                try:
+                    task.result()
+                except Exception as e:
+                    job.set_status(f"Error: {e}", "red")
+                if job.retry_at is not None:
+                    pending.append({"id": job.item_id, "link": job.link, "not_before": job.retry_at})
+                    print(f"{bcolors.ERROR}Not downloaded yet:{bcolors.ENDC} {job.link} ({job.status})")
+                    continue
+                finished_count += 1
+                if job.succeeded:
+                    print(f"{bcolors.OKSTATUS}Finished downloading:{bcolors.ENDC} {job.link}")
+                    if mover is not None:
+                        mover.submit(job)
+                else:
+                    failed.append(job)
+                    print(f"{bcolors.ERROR}Not downloaded:{bcolors.ENDC} {job.link} ({job.status})")
+            renderer.mark_changed()
+    finally:
+        consumer.cancel()
+        frames.cancel()
+    renderer.draw()
+    return failed, total_count
+
+# Says so when the per-host limit, rather than --jobs, caps how many downloads run at once
+def warn_single_host_limit(jobs):
+    hosts = {urlparse(link).hostname or "?" for link in queue}
+    if max_jobs_per_host and jobs > max_jobs_per_host and len(hosts) == 1:
+        print(f"{bcolors.OKSTATUS}Limited by max_jobs_per_host:{bcolors.ENDC} Every queued link is on {hosts.pop()}, so only {max_jobs_per_host} of the {jobs} downloads run at once. "
+              f"Set max_jobs_per_host=0 in {config_file_path} to let --jobs decide.\n")
+
+# Starts the downloading of the links in queue, running several at once. With a daemon, it keeps
+# running and takes commands on the control socket until it is stopped.
+def download_queue_parallel(jobs, resume=False, daemon=None):
+    load_session_modules()
+    current_download_directory = print_session_header()
+    if max_jobs_per_host:
+        print(f"Running up to {bcolors.COMPLETED}{jobs}{bcolors.ENDC} downloads at once, {max_jobs_per_host} per host.\n")
+    else:
+        print(f"Running up to {bcolors.COMPLETED}{jobs}{bcolors.ENDC} downloads at once.\n")
+    if daemon is not None:
+        print(f"{bcolors.OKSTATUS}Daemon is listening on:{bcolors.ENDC} {daemon_socket_path}\n")
+    start_session_metrics()
+    start_bandwidth_governor()
+
+    if use_temp_folder and not os.path.isdir(current_download_directory):
+        os.makedirs(current_download_directory)
+
+    use_embedded = engine == "embedded" and load_embedded_engine()
+    resumed = recover_interrupted_downloads(resume)
+    expand_playlists()
+    validate_queue(load_queue())
+    warn_single_host_limit(jobs)
+    mover = FileMover(temp_download_directory) if use_temp_folder else None
+
+    with Live(render_jobs_panel([], 0, len(queue)), auto_refresh = False) as live:
+        if daemon is not None:
+            failed, total_count = asyncio.run(run_daemon_session(jobs, live, use_embedded, resumed, mover, daemon))
+        else:
+            failed, total_count = asyncio.run(run_parallel_session(jobs, live, use_embedded, resumed, mover))
+
+    if failed:
+        print(f"\n{bcolors.ERROR}{len(failed)} of {total_count} links were not downloaded.{bcolors.ENDC}")
+
+    # Wait for the last files to be moved
+    if mover is not None:
+        move_files_to_final_directory(mover)
+
+# What a daemon has been told by its clients. The session reads it every time it wakes up.
+class DaemonState:
+    def __init__(self):
+        self.paused = False
+        self.stopping = False
+        self.wake = None
+        self.snapshot = lambda: {"running": [], "pending": 0, "finished": 0, "failed": 0}
+
+# Carries out one client request on the daemon and returns the response. Changes to the queue go
+# through the same functions the command line uses, and wake the session so it sees them at once.
+def handle_daemon_request(daemon, request):
+    command = request.get("command")
+    if command == "add":
+        output = queue_links(request.get("links", []), request.get("show_queue"), request.get("priority", 0))
+    elif command == "remove":
+        output = [remove_queue_link(int(request.get("index", -1)))]
+    elif command == "pause":
+        daemon.paused = True
+        output = ["Paused. Running downloads will finish, but no new ones start until resume."]
+    elif command == "resume":
+        daemon.paused = False
+        output = ["Resumed."]
+    elif command == "stop":
+        daemon.stopping = True
+        output = ["Stopping once the running downloads finish."]
+    elif command == "status":
+        return {"ok": True, "pid": os.getpid(), "paused": daemon.paused, "stopping": daemon.stopping, **daemon.snapshot()}
+    else:
+        return {"ok": False, "error": f"Unknown command: {command}"}
+    daemon.wake.set()
+    return {"ok": True, "output": output}
 
-# Moves all files in the temporary download directory to the proper download folder.
-def move_files_to_final_directory(temp_dir):
-    temporary_directory = os.listdir(os.path.expanduser(temp_dir))
-    if not temporary_directory:
-        print(f"No files found in {os.path.expanduser(temp_dir)} after download.")
+# Answers the requests of one client connection, a JSON object per line each way
+async def handle_daemon_client(daemon, reader, writer):
+    try:
+        while line := await reader.readline():
+            try:
+                response = handle_daemon_request(daemon, json.loads(line))
+            except (ValueError, TypeError, AttributeError, sqlite3.Error) as e:
+                response = {"ok": False, "error": str(e)}
+            writer.write(json.dumps(response).encode() + b"\n")
+            await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+# Runs the parallel session with the control socket open. SIGTERM stops the daemon the same way
+# the stop command does.
+async def run_daemon_session(jobs, live, use_embedded, resumed, mover, daemon):
+    daemon.wake = asyncio.Event()
+    if os.path.exists(daemon_socket_path):
+        os.remove(daemon_socket_path)
+    server = await asyncio.start_unix_server(lambda reader, writer: handle_daemon_client(daemon, reader, writer), path=daemon_socket_path)
+    os.chmod(daemon_socket_path, 0o600)
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGTERM, lambda: handle_daemon_request(daemon, {"command": "stop"}))
+    try:
+        return await run_parallel_session(jobs, live, use_embedded, resumed, mover, daemon)
+    finally:
+        loop.remove_signal_handler(signal.SIGTERM)
+        server.close()
+        os.remove(daemon_socket_path)
+
+# Sends a request to the running daemon and returns its response, or None if no daemon is
+# running. Only the socket is touched, so a client doesn't open the queue database at all.
+def send_daemon_command(request):
+    if not os.path.exists(daemon_socket_path):
+        return None
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.settimeout(daemon_timeout)
+            client.connect(daemon_socket_path)
+            client.sendall(json.dumps(request).encode() + b"\n")
+            with client.makefile("rb") as f:
+                response = f.readline()
+    except OSError:
+        return None
+    return json.loads(response) if response else None
+
+# Sends a request to the running daemon and prints what it did. Returns False if no daemon is running.
+def run_daemon_command(request):
+    response = send_daemon_command(request)
+    if response is None:
+        return False
+    if not response["ok"]:
+        print(f"{bcolors.ERROR}Error:{bcolors.ENDC} {response['error']}")
+    for line in response.get("output", []):
+        print(line)
+    return True
+
+# Prints what the running daemon is doing
+def show_daemon_status():
+    status = send_daemon_command({"command": "status"})
+    if status is None:
+        print(f"No daemon is running. Start one with daemon.")
         return
-    if debug:
-        print(f"Removing archive file at {os.path.expanduser(temp_dir)}downloaded_videos.txt")
-    # Move each file to the proper download directory
-    for filename in temporary_directory:
-        if "downloaded_videos.txt" in filename:
-            os.remove(os.path.join(os.path.expanduser(temp_dir), filename))
+    state = "stopping" if status["stopping"] else "paused" if status["paused"] else "running"
+    print(f"{bcolors.OKSTATUS}Daemon {status['pid']} is {state}:{bcolors.ENDC} {len(status['running'])} downloading, {status['pending']} waiting, {status['finished']} finished, {status['failed']} not downloaded.")
+    for job in status["running"]:
+        print(f"  {job['link']} - {job['status']}")
+
+# Returns the paths of the finished files in a job's workspace, leaving out any partial files
+def finished_download_files(workspace):
+    return [
+        os.path.join(workspace, filename) for filename in sorted(os.listdir(workspace))
+        if not unfinished_file_pattern.search(filename)
+    ]
+
+# Copies a file's contents between two open descriptors in the kernel, with copy_file_range or,
+# where that can't cross these filesystems, sendfile. Plain reads and writes are the last resort.
+def copy_file_contents(source_fd, destination_fd):
+    methods = [lambda offset: os.write(destination_fd, os.pread(source_fd, move_chunk_size, offset))]
+    if hasattr(os, "sendfile"):
+        methods.insert(0, lambda offset: os.sendfile(destination_fd, source_fd, offset, move_chunk_size))
+    if hasattr(os, "copy_file_range"):
+        methods.insert(0, lambda offset: os.copy_file_range(source_fd, destination_fd, move_chunk_size, offset))
+    offset = 0
+    while True:
+        try:
+            count = methods[0](offset)
+        except OSError as e:
+            if e.errno not in copy_fallback_errors or len(methods) == 1:
+                raise
+            methods.pop(0)
+            continue
+        if count == 0:
+            return
+        offset += count
+
+# Copies a file's contents with plain reads and writes, hashing each chunk on the way through, and
+# returns the digest. Used instead of the copy in the kernel when moves are verified, so the
+# source is only read once.
+def copy_and_hash_file_contents(source_fd, destination_fd):
+    digest = hashlib.blake2b()
+    offset = 0
+    while chunk := os.pread(source_fd, verify_chunk_size, offset):
+        digest.update(chunk)
+        view = memoryview(chunk)
+        while view:
+            view = view[os.write(destination_fd, view):]
+        offset += len(chunk)
+    return digest.hexdigest()
+
+# Returns the digest of a file as it is on disk. Its cached pages are dropped first, so it is
+# read back from the disk and not from memory.
+def file_digest(fd):
+    if hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    digest = hashlib.blake2b()
+    offset = 0
+    while chunk := os.pread(fd, verify_chunk_size, offset):
+        digest.update(chunk)
+        offset += len(chunk)
+    return digest.hexdigest()
+
+# Copies a file and syncs the copy to disk, then checks that the copy has the source's size and,
+# with verify_moves, its checksum. Returns what didn't match, or None.
+def copy_and_check_file(source_fd, destination_fd):
+    if verify_moves:
+        source_digest = copy_and_hash_file_contents(source_fd, destination_fd)
+    else:
+        copy_file_contents(source_fd, destination_fd)
+    os.fsync(destination_fd)
+    if os.fstat(destination_fd).st_size != os.fstat(source_fd).st_size:
+        return "size"
+    if verify_moves and file_digest(destination_fd) != source_digest:
+        return "checksum"
+    return None
+
+# Moves a file into the final directory. On the same filesystem this is a rename. Otherwise the
+# file is copied to a temporary name next to its destination, synced to disk, checked, and renamed
+# into place, so the final directory never holds half a file, even after a crash. A copy that
+# doesn't match is made once more before the move fails.
+def move_file(source, destination):
+    if os.path.isdir(source):
+        shutil.move(source, destination)
+        return
+    if os.stat(source).st_dev == os.stat(os.path.dirname(destination)).st_dev:
+        os.replace(source, destination)
+        return
+
+    partial_path = f"{destination}.moving"
+    try:
+        for attempt in range(2):
+            with open(source, 'rb') as source_file, open(partial_path, 'w+b') as partial_file:
+                mismatch = copy_and_check_file(source_file.fileno(), partial_file.fileno())
+            if mismatch is None:
+                break
+            print(f"{bcolors.ERROR}The copy of {source} does not match its {mismatch}.{bcolors.ENDC}")
         else:
-            temp_file_path = os.path.join(os.path.expanduser(temp_dir), filename)
-            global download_directory
-            final_file_path = os.path.join(os.path.expanduser(download_directory), filename)
+            raise OSError(errno.EIO, f"The copy does not match the file's {mismatch}", source)
+        shutil.copystat(source, partial_path)
+        os.replace(partial_path, destination)
+    except BaseException:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        raise
+    directory_fd = os.open(os.path.dirname(destination), os.O_RDONLY)
+    try:
+        os.fsync(directory_fd)
+    finally:
+        os.close(directory_fd)
+    os.remove(source)
+
+# Moves finished downloads from their workspaces in the temporary folder to the final directory
+# on background threads, at most mover_jobs at once, so the next download starts while files are copied
+class FileMover:
+    def __init__(self, temp_dir):
+        self.temp_dir = os.path.expanduser(temp_dir)
+        self.executor = ThreadPoolExecutor(max_workers=max(1, mover_jobs))
+        self.tasks = set()
+        self.moved_count = 0
+        self.failed_count = 0
+        self.reserved_bytes = 0
+        self.lock = threading.Lock()
+
+    # Queues a finished job's files for moving
+    def submit(self, job):
+        self.tasks = {task for task in self.tasks if not task.done()}
+        self.tasks.add(self.executor.submit(self.move, job))
+
+    # Returns whether the files fit in the final directory next to the moves already running, and
+    # if they do, sets the space aside until release_space. Files on the final directory's
+    # filesystem already are renamed, so they need no space.
+    def reserve_space(self, sources):
+        final_directory = os.path.expanduser(download_directory)
+        if not os.path.isdir(final_directory):
+            return 0
+        sizes = [os.path.getsize(source) for source in sources if os.path.isfile(source) and os.stat(source).st_dev != os.stat(final_directory).st_dev]
+        with self.lock:
+            if sum(sizes) > shutil.disk_usage(final_directory).free - self.reserved_bytes:
+                return None
+            self.reserved_bytes += sum(sizes)
+        return sum(sizes)
+
+    def release_space(self, byte_count):
+        with self.lock:
+            self.reserved_bytes -= byte_count
+
+    # Moves a job's finished files, then deletes what is left in its workspace and records it as
+    # moved. A job whose files don't fit in the final directory isn't moved at all, so no half
+    # copied file fills it up.
+    def move(self, job):
+        started = time.monotonic()
+        sources = finished_download_files(job.directory)
+        reserved = self.reserve_space(sources)
+        if reserved is None:
+            print(f"{bcolors.ERROR}Error:{bcolors.ENDC} Not enough space in {os.path.expanduser(download_directory)} for {job.link}, its files are kept in {job.directory}")
+            with self.lock:
+                self.failed_count += 1
+            add_metric("yt_dlp_sc_moves_total", 1, result="no_space")
+            log_event("move_failed", item_id=job.item_id, link=job.link, error="not enough space in the final directory", seconds=round(time.monotonic() - started, 3))
+            print(fail_move(job, "not enough space in the final directory"))
+            return
+        try:
+            self.move_files(job, sources, started)
+        finally:
+            self.release_space(reserved)
+
+    def move_files(self, job, sources, started):
+        byte_count = 0
+        for source in sources:
+            destination = os.path.join(os.path.expanduser(download_directory), os.path.basename(source))
             if not suppress_output:
-                print(f"Moving {temp_file_path} to {final_file_path}")
-            shutil.move(temp_file_path, final_file_path)
-    clear_queue()
-    if os.path.expanduser("~/Downloads/yt-dlp-sc") in os.path.expanduser(temp_dir):
+                print(f"Moving {source} to {destination}")
+            try:
+                size = os.path.getsize(source) if os.path.isfile(source) else 0
+                move_file(source, destination)
+            except OSError as e:
+                print(f"{bcolors.ERROR}Error:{bcolors.ENDC} Could not move {source}: {e}")
+                with self.lock:
+                    self.failed_count += 1
+                add_metric("yt_dlp_sc_moves_total", 1, result="failed")
+                log_event("move_failed", item_id=job.item_id, link=job.link, path=source, error=str(e), seconds=round(time.monotonic() - started, 3))
+                print(fail_move(job, f"could not move {os.path.basename(source)}: {e}"))
+                return
+            byte_count += size
+            with self.lock:
+                self.moved_count += 1
+        shutil.rmtree(job.directory, ignore_errors=True)
+        seconds = time.monotonic() - started
+        record_phase("move", seconds)
+        add_metric("yt_dlp_sc_moves_total", 1, result="moved")
+        add_metric("yt_dlp_sc_move_seconds_total", seconds)
+        add_metric("yt_dlp_sc_moved_bytes_total", byte_count)
+        log_event("moved", item_id=job.item_id, link=job.link, bytes=byte_count, seconds=round(seconds, 3))
+        finish_moved_download(job)
+
+    # Returns whether any of the queued moves hasn't finished yet
+    def moving(self):
+        return any(not task.done() for task in self.tasks)
+
+    # Waits for one of the queued moves to finish. Returns False if none was queued.
+    def wait_for_move(self):
+        self.tasks = {task for task in self.tasks if not task.done()}
+        if not self.tasks:
+            return False
+        _, self.tasks = wait(self.tasks, return_when=FIRST_COMPLETED)
+        return True
+
+    # Waits for every queued move to finish
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+# Waits for the background moves to finish, then removes the default temporary folder if it is
+# empty. Workspaces of failed jobs are kept to resume from.
+def move_files_to_final_directory(mover):
+    temp_dir = mover.temp_dir
+    mover.close()
+    if not mover.moved_count and not mover.failed_count:
+        print(f"No files found in {temp_dir} after download.")
+
+    if os.path.expanduser("~/Downloads/yt-dlp-sc") in temp_dir and os.path.isdir(temp_dir) and not os.listdir(temp_dir):
         os.rmdir(temp_dir)
         if debug:
-            print(f"Removed empty directory at {os.path.expanduser(temp_dir)}")
+            print(f"Removed empty directory at {temp_dir}")
 
-    if not suppress_output:
+    if mover.failed_count:
+        print(f"{bcolors.ERROR}{mover.failed_count} downloads could not be moved to the final directory.{bcolors.ENDC}")
+    elif not suppress_output:
         print(f"All downloaded files have been moved to the final directory.")
 
 # Prints the current settings and links in queue
@@ -741,24 +3341,253 @@ def show_settings():
     elif not debug:
         print(f"  {bcolors.OKRED}Disabled{bcolors.ENDC}\n")
 
+    # Download engine
+    print(f"  {bcolors.UNDERLINE}Download engine is:{bcolors.ENDC}")
+    print(f"  {bcolors.OKBLUE}{engine}{bcolors.ENDC}\n")
+
+    # Parallel downloads
+    print(f"  {bcolors.UNDERLINE}Parallel downloads per host are limited to:{bcolors.ENDC}")
+    print(f"  {bcolors.OKBLUE}{max_jobs_per_host or 'Unlimited'}{bcolors.ENDC}\n")
+
+    # Tuned concurrent fragments
+    if tune_fragments:
+        load_fragment_tuning()
+        print(f"  {bcolors.UNDERLINE}Concurrent fragments (-N) are tuned per host, up to {max_concurrent_fragments}:{bcolors.ENDC}")
+        for host, measurements in sorted(fragment_tuning.items()):
+            best = max(measurements, key=lambda threads: measurements[threads]["speed"])
+            print(f"  {bcolors.OKBLUE}{host}: -N {best} at {format_bytes(measurements[best]['speed'])}/s{bcolors.ENDC}")
+        print(f"")
 
 
     # Download queue
     print(f"  {bcolors.OKBLUE}{bcolors.BOLD}{bcolors.COMPLETED}Current download queue:{bcolors.ENDC}")
-    if not is_file_blank(queue_file_path):
+    if queue:
         for index, link in enumerate(queue):
             print(f"  {bcolors.OKSTATUS}{index} - {link}{bcolors.ENDC}")
         print(f"")
     else:
         print(f"  Nothing in queue\n")
 
+    # Failed list
+    failed_count = len(failed_items())
+    if failed_count:
+        print(f"  {bcolors.ERROR}{failed_count} downloads failed for good, see failed.{bcolors.ENDC}\n")
+
+# Prints the failed list: links that failed for good, with how often they were tried and why
+def show_failed():
+    rows = failed_items()
+    if not rows:
+        print(f"No failed downloads.")
+        return
+    print(f"{bcolors.OKBLUE}{bcolors.BOLD}{bcolors.COMPLETED}Failed downloads:{bcolors.ENDC}")
+    for row in rows:
+        failed_at = time.strftime("%Y-%m-%d %H:%M", time.localtime(row["updated_at"]))
+        print(f"  {bcolors.OKSTATUS}{row['id']} - {row['link']}{bcolors.ENDC}")
+        print(f"      {row['attempts']} attempts, last on {failed_at}: {row['last_error'] or 'unknown error'}")
+    print(f"\nUse requeue to put them all back in the queue, or requeue <id>... for some of them.")
+
+# Takes --priority <low|normal|high> out of the arguments of an add command. Returns the priority,
+# normal if none is given, and the other arguments, or None as the priority if it is not valid.
+def parse_priority_argument(arguments):
+    if '--priority' not in arguments:
+        return priority_levels["normal"], arguments
+    index = arguments.index('--priority')
+    if index + 1 >= len(arguments) or arguments[index + 1] not in priority_levels:
+        return None, arguments
+    return priority_levels[arguments[index + 1]], arguments[:index] + arguments[index + 2:]
+
+# Returns the URL a subscription or a queued channel is listed by. A Youtube channel's own page
+# lists its tabs rather than its videos, so the videos tab is listed instead.
+def listing_url(url):
+    url = normalize_link(url)
+    parsed = urlparse(url)
+    if parsed.hostname == "www.youtube.com" and youtube_channel_pattern.match(parsed.path):
+        return urlunparse(parsed._replace(path=parsed.path + "/videos"))
+    return url
+
+# Subscribes to a channel or playlist. Unless backfill is off, the first sync queues every video
+# it has; otherwise it only records where the channel is now, and later syncs queue what's new.
+# Returns False if it is subscribed to already.
+def add_subscription(url, priority=0, backfill=True):
+    with queue_transaction() as database:
+        cursor = database.execute(
+            "INSERT OR IGNORE INTO subscriptions (url, priority, backfill, added_at) VALUES (?, ?, ?, ?)",
+            (listing_url(url), priority, int(backfill), time.time()),
+        )
+        return cursor.rowcount == 1
+
+# Removes a subscription by id. The videos it queued stay in the queue.
+def remove_subscription(subscription_id):
+    with queue_transaction() as database:
+        row = database.execute("SELECT url FROM subscriptions WHERE id = ?", (subscription_id,)).fetchone()
+        database.execute("DELETE FROM subscriptions WHERE id = ?", (subscription_id,))
+    return row["url"] if row else None
+
+# Returns the subscriptions, or only the ones with the given ids
+def subscription_rows(subscription_ids=None):
+    rows = [dict(row) for row in open_queue_database().execute("SELECT * FROM subscriptions ORDER BY id")]
+    return [row for row in rows if not subscription_ids or row["id"] in subscription_ids]
+
+# Lists a subscription's videos newest first, and stops yt-dlp as soon as it reaches one that the
+# last sync saw or that is in the download archive, so only the first page of a channel is fetched
+# when little is new. Only the newest limit videos are listed when a limit is given. Returns the
+# new (id, link, duration) entries, or None if listing failed.
+def list_new_entries(url, watermark, limit=None):
+    command = ["yt-dlp"] + yt_dlp_options.split() + ["--flat-playlist", "--lazy-playlist", "--no-warnings",
+               "--print", "%(id)s\t%(url)s\t%(duration)s", url]
+    if limit is not None:
+        command[-1:-1] = ["--playlist-items", f"1:{limit}"]
+    seen = set(watermark)
+    entries = []
+    reached = False
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    try:
+        for line in process.stdout:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) != 3:
+                continue
+            video_id, link, duration = fields
+            link = normalize_link(link)
+            archive_key = link_archive_key(link)
+            if video_id in seen or (archive_key and archived_keys([archive_key])):
+                reached = True
+                break
+            entries.append((video_id, link, float(duration) if duration not in ("NA", "None") else None))
+    finally:
+        if reached:
+            process.kill()
+        _, errors = process.communicate()
+    if not reached and process.returncode != 0:
+        if debug:
+            print(f"{bcolors.ERROR}DEBUG Error 70:{bcolors.ENDC} Could not list {url}: {errors.strip()}")
+        return None
+    return entries
+
+# Lists what's new in one subscription and queues it, oldest first, with the subscription as its
+# source. Returns how many videos were queued, or None if the subscription could not be listed.
+def sync_subscription(subscription):
+    started = time.monotonic()
+    watermark = json.loads(subscription["watermark"])
+    # The first sync of a subscription without backfill only records where the channel is now
+    record_only = subscription["synced_at"] is None and not subscription["backfill"]
+    entries = list_new_entries(subscription["url"], watermark, watermark_size if record_only else None)
+    if entries is None:
+        log_event("sync_failed", subscription_id=subscription["id"], url=subscription["url"], seconds=round(time.monotonic() - started, 3))
+        return None
+    added = 0
+    if entries and not record_only:
+        links = [link for _, link, _ in reversed(entries)]
+        durations = {link: duration for _, link, duration in entries}
+        added = enqueue_links(links, subscription["priority"], f"subscription {subscription['id']}", durations)
+    watermark = ([video_id for video_id, _, _ in entries] + watermark)[:watermark_size]
+    with queue_transaction() as database:
+        database.execute(
+            "UPDATE subscriptions SET watermark = ?, synced_at = ? WHERE id = ?",
+            (json.dumps(watermark), time.time(), subscription["id"]),
+        )
+    log_event("synced", subscription_id=subscription["id"], url=subscription["url"], new=len(entries), queued=added, seconds=round(time.monotonic() - started, 3))
+    return added
+
+# Syncs every subscription, or only the ones with the given ids, prefetch_jobs at a time
+def sync_subscriptions(subscription_ids=None):
+    subscriptions = subscription_rows(subscription_ids)
+    if not subscriptions:
+        print(f"No subscriptions to sync. Add one with subscribe <url>.")
+        return
+    load_session_modules()
+    print(f"{bcolors.OKSTATUS}Syncing {len(subscriptions)} subscriptions{bcolors.ENDC}")
+    with ThreadPoolExecutor(max_workers=max(prefetch_jobs, 1)) as pool:
+        results = list(pool.map(sync_subscription, subscriptions))
+    for subscription, added in zip(subscriptions, results):
+        if added is None:
+            print(f"{bcolors.ERROR}Could not sync:{bcolors.ENDC} {subscription['url']}")
+        else:
+            print(f"{bcolors.COMPLETED}Queued {added} new videos from:{bcolors.ENDC} {subscription['url']}")
+    print(f"Queued {sum(added or 0 for added in results)} new videos in total.")
+
+# Prints the subscriptions and when each was last synced
+def show_subscriptions():
+    subscriptions = subscription_rows()
+    if not subscriptions:
+        print(f"No subscriptions. Add one with subscribe <url>.")
+        return
+    print(f"{bcolors.OKBLUE}{bcolors.BOLD}{bcolors.COMPLETED}Subscriptions:{bcolors.ENDC}")
+    for subscription in subscriptions:
+        synced = time.strftime("%Y-%m-%d %H:%M", time.localtime(subscription["synced_at"])) if subscription["synced_at"] else "never"
+        priority = next(name for name, level in priority_levels.items() if level == subscription["priority"])
+        print(f"  {bcolors.OKSTATUS}{subscription['id']} - {subscription['url']}{bcolors.ENDC}")
+        print(f"      {priority} priority, last synced {synced}")
+
+# Parses the arguments following the start command. Returns None if they are not valid.
+def parse_start_arguments(arguments):
+    start_options = {"jobs": 1, "resume": False, "profile": False, "profile_file": None, "daemon": False}
+    index = 0
+    while index < len(arguments):
+        argument = arguments[index]
+        if argument == '-j' or argument == '--jobs':
+            if index + 1 >= len(arguments) or not arguments[index + 1].isdigit() or int(arguments[index + 1]) < 1:
+                return None
+            start_options["jobs"] = int(arguments[index + 1])
+            index += 2
+        elif argument == '--resume':
+            start_options["resume"] = True
+            index += 1
+        elif argument == '--profile':
+            start_options["profile"] = True
+            index += 1
+            # An optional file to write a cProfile dump of the session to
+            if index < len(arguments) and not arguments[index].startswith("-"):
+                start_options["profile_file"] = arguments[index]
+                index += 1
+        else:
+            return None
+    return start_options
+
+# Runs a download session, timing its phases with --profile and writing a cProfile dump if a
+# file was given. cProfile only sees the main thread, where the asyncio sessions run.
+def run_start_session(start_options):
+    global phase_timings
+    if start_options["profile"]:
+        phase_timings = {}
+    profiler = importlib.import_module("cProfile").Profile() if start_options["profile_file"] else None
+    started = time.monotonic()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        if start_options["daemon"]:
+            download_queue_parallel(start_options["jobs"], start_options["resume"], DaemonState())
+        elif start_options["jobs"] > 1:
+            download_queue_parallel(start_options["jobs"], start_options["resume"])
+        else:
+            download_queue(start_options["resume"])
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        if phase_timings is not None:
+            record_phase("session", time.monotonic() - started)
+            print_profile_report()
+        if profiler is not None:
+            profiler.dump_stats(start_options["profile_file"])
+            print(f"Wrote the session's cProfile dump to {start_options['profile_file']}, view it with python3 -m pstats {start_options['profile_file']}")
+
 # Main loop, handles command options
 def main():
-    load_queue()
+    # Version and help are answered before the options and the queue are read
+    if len(sys.argv) > 1 and (sys.argv[1] == '-v' or sys.argv[1] == '--version'):
+        if len(sys.argv) < 3:
+            print_version()
+        else:
+            print(f"This option does not take arguments")
+        return
+    elif len(sys.argv) > 1 and (sys.argv[1] == '-h' or sys.argv[1] == '--help'):
+        show_help()
+        return
+
     load_options()
 
     # Blank command, defaults to show
     if len(sys.argv) < 2:
+        load_queue()
         show_settings()
         return
 
@@ -770,13 +3599,52 @@ def main():
 
     # Add command
     elif command == '-a' or command == '--add':
-        if len(sys.argv) < 3:
-            print(f"Usage: -a/--add <link>")
+        priority, arguments = parse_priority_argument([argument for argument in sys.argv[2:] if argument != '--show-queue'])
+        if priority is None or not arguments:
+            print(f"Usage: -a/--add <link|-> [<link> ...] [--show-queue] [--priority <low|normal|high>]")
+            return
+        links = []
+        for argument in arguments:
+            if argument == '-':
+                links += read_links(sys.stdin)
+            else:
+                links.append(argument)
+        show_queue = True if '--show-queue' in sys.argv[2:] else None
+        if not run_daemon_command({"command": "add", "links": links, "show_queue": show_queue, "priority": priority}):
+            add_to_queue(links, show_queue, priority)
+
+    # Add file command
+    elif command == '-A' or command == '--add-file':
+        priority, arguments = parse_priority_argument([argument for argument in sys.argv[2:] if argument != '--show-queue'])
+        if priority is None or not arguments:
+            print(f"Usage: -A/--add-file <file> [<file> ...] [--show-queue] [--priority <low|normal|high>]")
+            return
+        links = []
+        for path in arguments:
+            try:
+                with open(os.path.expanduser(path), 'r') as f:
+                    links += read_links(f)
+            except OSError as e:
+                print(f"{bcolors.ERROR}Error:{bcolors.ENDC} Could not read {path}: {e.strerror}")
+                return
+        if not run_daemon_command({"command": "add", "links": links, "show_queue": '--show-queue' in sys.argv[2:], "priority": priority}):
+            add_to_queue(links, '--show-queue' in sys.argv[2:], priority)
+
+    # Import archive command
+    elif command == '--import-archive':
+        if len(sys.argv) != 3:
+            print(f"Usage: --import-archive <archive file>")
+            return
+        try:
+            count = import_archive_file(os.path.expanduser(sys.argv[2]))
+        except OSError as e:
+            print(f"{bcolors.ERROR}Error:{bcolors.ENDC} Could not read {sys.argv[2]}: {e.strerror}")
             return
-        add_to_queue(sys.argv[2])
+        print(f"Imported {count} entries into the download archive.")
 
     # Show command
     elif command == 'show':
+        load_queue()
         show_settings()
 
     # Remove command
@@ -786,7 +3654,8 @@ def main():
             return
         try:
             index = int(sys.argv[2])
-            remove_from_queue(index)
+            if not run_daemon_command({"command": "remove", "index": index}):
+                remove_from_queue(index)
         except ValueError:
             print(f"Invalid index")
 
@@ -812,6 +3681,13 @@ def main():
             else:
                 print(f"Usage: -s/--suppress <y|n>")
 
+    # Engine command
+    elif command == '-e' or command == '--engine':
+        if len(sys.argv) == 3:
+            set_engine(sys.argv[2])
+        else:
+            print(f"Usage: -e/--engine <subprocess|embedded>")
+
     # Options command
     elif command == '-o' or command == '--options':
         if len(sys.argv) < 3:
@@ -819,12 +3695,87 @@ def main():
             return
         set_yt_dlp_options(' '.join(sys.argv[2:]))
 
+    # Prefetch command
+    elif command == 'prefetch':
+        if not load_queue():
+            print(f"The queue is empty. Please add links before prefetching.")
+            return
+        prefetch_queue()
+
+    # Failed command
+    elif command == 'failed':
+        show_failed()
+
+    # Requeue command
+    elif command == 'requeue':
+        if not all(argument.isdigit() for argument in sys.argv[2:]):
+            print(f"Usage: requeue [<id>...]")
+            return
+        requeued = requeue_failed_items({int(argument) for argument in sys.argv[2:]})
+        print(f"Put {requeued} failed downloads back in the queue.")
+
     # Start command
     elif command == 'start':
-        if not queue:
+        start_options = parse_start_arguments(sys.argv[2:])
+        if start_options is None:
+            print(f"Usage: start [-j/--jobs <number>] [--resume] [--profile [file]]")
+            return
+        if send_daemon_command({"command": "status"}) is not None:
+            print(f"A daemon is running and downloads the queue. Use status to see what it is doing.")
+            return
+        if not load_queue():
             print(f"The queue is empty. Please add links before starting the download.")
             return
-        download_queue()
+        run_start_session(start_options)
+
+    # Subscribe command
+    elif command == 'subscribe':
+        priority, arguments = parse_priority_argument([argument for argument in sys.argv[2:] if argument != '--new-only'])
+        if priority is None or len(arguments) != 1:
+            print(f"Usage: subscribe <channel or playlist url> [--priority <low|normal|high>] [--new-only]")
+            return
+        if add_subscription(arguments[0], priority, '--new-only' not in sys.argv[2:]):
+            print(f"Subscribed to: {listing_url(arguments[0])}")
+        else:
+            print(f"Already subscribed to: {listing_url(arguments[0])}")
+
+    # Unsubscribe command
+    elif command == 'unsubscribe':
+        if len(sys.argv) != 3 or not sys.argv[2].isdigit():
+            print(f"Usage: unsubscribe <id>")
+            return
+        url = remove_subscription(int(sys.argv[2]))
+        print(f"Unsubscribed from: {url}" if url else f"No subscription with id {sys.argv[2]}.")
+
+    # Subscriptions command
+    elif command == 'subscriptions':
+        show_subscriptions()
+
+    # Sync command
+    elif command == 'sync':
+        if not all(argument.isdigit() for argument in sys.argv[2:]):
+            print(f"Usage: sync [<id>...]")
+            return
+        sync_subscriptions({int(argument) for argument in sys.argv[2:]})
+
+    # Daemon command
+    elif command == 'daemon':
+        start_options = parse_start_arguments(sys.argv[2:])
+        if start_options is None:
+            print(f"Usage: daemon [-j/--jobs <number>] [--resume] [--profile [file]]")
+            return
+        if send_daemon_command({"command": "status"}) is not None:
+            print(f"A daemon is already running. Use status to see what it is doing.")
+            return
+        start_options["daemon"] = True
+        run_start_session(start_options)
+
+    # Daemon control commands
+    elif command == 'status':
+        show_daemon_status()
+    elif command == 'pause' or command == 'resume' or command == 'stop':
+        if not run_daemon_command({"command": command}):
+            print(f"No daemon is running. Start one with daemon.")
 
     # Temp command
     elif command == '-t' or command == '--temp':
@@ -850,16 +3801,6 @@ def main():
             else:
                 print(f"Usage: -p/--pretty <y|n>")
 
-    # Help command
-    elif command == '-h' or command == '--help':
-        show_help()
-
-    # Version command
-    elif command == '-v' or command == '--version':
-        if len(sys.argv) < 3:
-            print_version()
-        else:
-            print(f"This option does not take arguments")
     # Unknown command
     else:
         print(f"Unknown command: {command}")